@@ -1,18 +1,95 @@
 # run_triage.py
 
+import argparse
+import logging
+import sys
+from datetime import date
+
 from smart_email_agent.storage import Storage
-from smart_email_agent.triage import run_triage
+from smart_email_agent.triage import iter_backfill, run_triage
+from smart_email_agent.worker import run_daemons, run_workers
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description="Smart Email Triage Agent")
+    parser.add_argument("--clear-db", action="store_true", help="Delete all stored emails and tasks.")
+    parser.add_argument("--migrate", action="store_true", help="Apply pending database schema migrations.")
+    parser.add_argument(
+        "--backfill",
+        metavar="QUERY",
+        nargs="?",
+        const="",
+        default=None,
+        help="Triage historical mail matching a Gmail search query (resumable).",
+    )
+    parser.add_argument("--after", type=date.fromisoformat, help="Backfill window start (YYYY-MM-DD).")
+    parser.add_argument("--before", type=date.fromisoformat, help="Backfill window end, exclusive (YYYY-MM-DD).")
+    parser.add_argument("--restart", action="store_true", help="Ignore the backfill checkpoint and start over.")
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Triage every account in GMAIL_ACCOUNTS, sharing mailboxes with other workers via leases.",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep polling (POLL_INTERVAL_SECONDS, backing off when idle) until SIGTERM.",
+    )
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes to run on this host.")
+    parser.add_argument("--accounts", help="Comma-separated accounts for --worker (default: GMAIL_ACCOUNTS).")
+    return parser.parse_args(argv)
 
-import sys
 
 if __name__ == "__main__":
-    storage = Storage()
+    args = _parse_args(sys.argv[1:])
+
+    if args.migrate:
+        storage = Storage(check_schema=False)
+        applied = storage.migrate()
+        if applied:
+            print(f"Applied migrations: {', '.join(map(str, applied))}.")
+        print(f"Schema is at version {storage.schema_version()}.")
+        embedded = storage.backfill_embeddings()
+        if embedded:
+            print(f"Computed embeddings for {embedded} stored emails.")
+        sys.exit(0)
 
-    if len(sys.argv) > 1 and sys.argv[1] == "--clear-db":
+    if args.clear_db:
+        storage = Storage()
         storage.clear_all()
         print("Database cleared.")
         storage.close()
         sys.exit(0)
 
-    run_triage()
+    if args.backfill is not None:
+        storage = Storage()
+        try:
+            count = 0
+            for pe in iter_backfill(
+                query=args.backfill,
+                after=args.after,
+                before=args.before,
+                storage=storage,
+                restart=args.restart,
+            ):
+                count += 1
+                if count % 100 == 0:
+                    print(f"Backfilled {count} emails...")
+            print(f"Backfill complete: {count} new emails triaged.")
+        finally:
+            storage.close()
+        sys.exit(0)
+
+    accounts = [a.strip() for a in args.accounts.split(",") if a.strip()] if args.accounts else None
+
+    if args.daemon:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+        run_daemons(args.processes, accounts=accounts)
+        sys.exit(0)
 
+    if args.worker:
+        total = run_workers(args.processes, accounts=accounts)
+        print(f"Workers done: {total} new emails triaged.")
+        sys.exit(0)
+
+    run_triage()
@@ -1,24 +1,32 @@
 import os
 import json
+from typing import Dict, List, Optional, Tuple
+
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from .rate_limit import get_limiter
+
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Retries/backoff are handled by the shared "openai" limiter (rate_limit.py),
+# so the SDK's own retries are turned off to avoid compounding them.
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 
-SYSTEM_PROMPT = """
-You are an intelligent email triage assistant.
+MODEL = "gpt-5.1"
+# Bump whenever SYSTEM_PROMPT or the output schema changes, so cached
+# classifications produced by an older prompt are not reused.
+PROMPT_VERSION = "1"
 
-You MUST respond ONLY with a single valid JSON object with this exact schema:
-{
+_SCHEMA_FIELDS = """
   "summary": "1-3 sentence plain-English summary of the email",
   "urgency": "urgent | normal | low",
   "category": "work | school | personal | promo | automated",
   "tasks": ["task1", "task2"],
   "reply_draft": "suggested reply text"
-}
+""".strip("\n")
 
+_RULES = """
 Rules:
 - No extra commentary, no explanations, no markdown, no code fences.
 - "summary" should focus on the main point and key actions/dates, not every detail.
@@ -28,6 +36,32 @@ Rules:
   and you may set reply_draft to an empty string.
 """.strip()
 
+SYSTEM_PROMPT = f"""
+You are an intelligent email triage assistant.
+
+You MUST respond ONLY with a single valid JSON object with this exact schema:
+{{
+{_SCHEMA_FIELDS}
+}}
+
+{_RULES}
+""".strip()
+
+BATCH_SYSTEM_PROMPT = f"""
+You are an intelligent email triage assistant.
+
+You will receive several emails, each starting with a line "=== EMAIL id=<id> ===".
+
+You MUST respond ONLY with a single valid JSON array containing exactly one object
+per email, each with this exact schema:
+{{
+  "id": "the email id from its === EMAIL line",
+{_SCHEMA_FIELDS}
+}}
+
+{_RULES}
+""".strip()
+
 def _clean_json_text(raw: str) -> str:
     """
     Clean up common patterns like ```json ... ``` wrappers before json.loads.
@@ -44,14 +78,8 @@ def _clean_json_text(raw: str) -> str:
     return text
 
 
-def classify_with_ai(subject: str, body: str, sender: str) -> dict:
-    """
-    Uses GPT-5.1 via Chat Completions.
-    Returns a Python dict with keys: urgency, category, tasks, reply_draft.
-    Raises an exception if JSON cannot be parsed (caught in triage.py).
-    """
-
-    user_prompt = f"""
+def _format_email(subject: str, body: str, sender: str) -> str:
+    return f"""
 EMAIL SENDER: {sender}
 SUBJECT: {subject}
 
@@ -59,8 +87,25 @@ BODY:
 {body}
 """.strip()
 
-    response = client.chat.completions.create(
-        model="gpt-5.1",
+
+def classify_with_ai(
+    subject: str,
+    body: str,
+    sender: str,
+    api_client: Optional[OpenAI] = None,
+) -> dict:
+    """
+    Uses GPT-5.1 via Chat Completions.
+    Returns a Python dict with keys: urgency, category, tasks, reply_draft.
+    Raises an exception if JSON cannot be parsed (caught in triage.py).
+    `api_client` overrides the module-level OpenAI client (e.g. a local stub).
+    """
+
+    user_prompt = _format_email(subject, body, sender)
+
+    response = get_limiter("openai").call(
+        (api_client or client).chat.completions.create,
+        model=MODEL,
         messages=[
             {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": user_prompt},
@@ -77,3 +122,167 @@ BODY:
         return json.loads(text)
     except json.JSONDecodeError as e:
         raise ValueError(f"AI returned invalid JSON: {content}") from e
+
+
+# ============================================================
+# Batched classification (several emails per request)
+# ============================================================
+
+URGENCIES = {"urgent", "normal", "low"}
+CATEGORIES = {"work", "school", "personal", "promo", "automated"}
+
+# Default prompt-token budget for one batched request, and a cap on the
+# number of emails packed together (keeps the JSON answer manageable).
+DEFAULT_BATCH_TOKEN_BUDGET = 6000
+DEFAULT_BATCH_MAX_ITEMS = 10
+
+# (ai_result, error) per email id, like triage.classify_emails
+BatchResult = Dict[str, Tuple[Optional[dict], Optional[Exception]]]
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap local token estimate (~4 characters per token for English text)."""
+    return max(1, len(text or "") // 4)
+
+
+def validate_classification(item: dict) -> dict:
+    """
+    Check one result against the SYSTEM_PROMPT schema.
+    Returns a dict with just the schema keys; raises ValueError otherwise.
+    """
+    if not isinstance(item, dict):
+        raise ValueError(f"Expected a JSON object, got: {item!r}")
+    if item.get("urgency") not in URGENCIES:
+        raise ValueError(f"Invalid urgency: {item.get('urgency')!r}")
+    if item.get("category") not in CATEGORIES:
+        raise ValueError(f"Invalid category: {item.get('category')!r}")
+    tasks = item.get("tasks") or []
+    if not isinstance(tasks, list) or not all(isinstance(t, str) for t in tasks):
+        raise ValueError(f"Invalid tasks: {tasks!r}")
+    summary = item.get("summary") or ""
+    reply_draft = item.get("reply_draft") or ""
+    if not isinstance(summary, str) or not isinstance(reply_draft, str):
+        raise ValueError("summary and reply_draft must be strings")
+    return {
+        "summary": summary,
+        "urgency": item["urgency"],
+        "category": item["category"],
+        "tasks": tasks,
+        "reply_draft": reply_draft,
+    }
+
+
+def _email_block(email: Dict[str, str]) -> str:
+    return f"=== EMAIL id={email['id']} ===\n" + _format_email(
+        email["subject"], email["body"], email["sender"]
+    )
+
+
+def pack_email_batches(
+    emails: List[Dict[str, str]],
+    token_budget: int = DEFAULT_BATCH_TOKEN_BUDGET,
+    max_items: int = DEFAULT_BATCH_MAX_ITEMS,
+) -> List[List[Dict[str, str]]]:
+    """
+    Greedily group emails (in order) so each group's prompt stays within
+    `token_budget` estimated tokens and `max_items` emails.
+    An email larger than the budget on its own gets a group by itself.
+    """
+    budget = max(1, token_budget - estimate_tokens(BATCH_SYSTEM_PROMPT))
+    batches: List[List[Dict[str, str]]] = []
+    current: List[Dict[str, str]] = []
+    used = 0
+
+    for email in emails:
+        cost = estimate_tokens(_email_block(email))
+        if current and (used + cost > budget or len(current) >= max_items):
+            batches.append(current)
+            current, used = [], 0
+        current.append(email)
+        used += cost
+
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _request_batch(emails: List[Dict[str, str]], api_client) -> str:
+    user_prompt = "\n\n".join(_email_block(e) for e in emails)
+    response = get_limiter("openai").call(
+        api_client.chat.completions.create,
+        model=MODEL,
+        messages=[
+            {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt},
+        ],
+        temperature=0,
+    )
+    return response.choices[0].message.content
+
+
+def _parse_batch(content: str) -> Dict[str, dict]:
+    """Map email id -> raw item from a batch answer ({} if not a JSON array)."""
+    try:
+        items = json.loads(_clean_json_text(content))
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(items, list):
+        return {}
+    return {
+        str(item["id"]): item
+        for item in items
+        if isinstance(item, dict) and "id" in item
+    }
+
+
+def classify_batch_with_ai(
+    emails: List[Dict[str, str]],
+    api_client: Optional[OpenAI] = None,
+) -> BatchResult:
+    """
+    Classify several emails (dicts with id, sender, subject, body) in one request.
+
+    Items missing from the answer or failing validation are split in half and
+    retried on their own; a single email that still fails falls back to
+    classify_with_ai. A failed request (network, quota, ...) is reported as
+    the error for every email in it rather than retried.
+    Returns {email id: (ai_result, error)}.
+    """
+    api_client = api_client or client
+    results: BatchResult = {}
+    if not emails:
+        return results
+
+    if len(emails) == 1:
+        e = emails[0]
+        try:
+            results[e["id"]] = (
+                classify_with_ai(e["subject"], e["body"], e["sender"], api_client=api_client),
+                None,
+            )
+        except Exception as ex:
+            results[e["id"]] = (None, ex)
+        return results
+
+    try:
+        parsed = _parse_batch(_request_batch(emails, api_client))
+    except Exception as ex:
+        return {e["id"]: (None, ex) for e in emails}
+
+    failed: List[Dict[str, str]] = []
+    for e in emails:
+        item = parsed.get(str(e["id"]))
+        try:
+            if item is None:
+                raise ValueError(f"Missing result for email {e['id']}")
+            results[e["id"]] = (validate_classification(item), None)
+        except ValueError:
+            failed.append(e)
+
+    if failed:
+        mid = (len(failed) + 1) // 2
+        for half in (failed[:mid], failed[mid:]):
+            results.update(classify_batch_with_ai(half, api_client=api_client))
+
+    return results
+
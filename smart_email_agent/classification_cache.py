@@ -0,0 +1,201 @@
+# smart_email_agent/classification_cache.py
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from .ai_classifier import MODEL, PROMPT_VERSION
+from .storage import Storage
+
+_WS_RE = re.compile(r"\s+")
+
+
+def _normalize(text: str) -> str:
+    return _WS_RE.sub(" ", text or "").strip()
+
+
+def classification_cache_key(sender: str, subject: str, body: str) -> str:
+    """
+    Stable hash of (sender, subject, body, prompt version, model).
+    Whitespace is collapsed and the sender lower-cased, so re-sent copies of
+    the same automated mail map to the same key.
+    """
+    payload = json.dumps(
+        [
+            PROMPT_VERSION,
+            MODEL,
+            _normalize(sender).lower(),
+            _normalize(subject),
+            _normalize(body),
+        ],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """Small thread-safe in-process LRU with per-entry TTL."""
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[timedelta] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[datetime, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, ttl: Optional[timedelta] = None) -> Optional[dict]:
+        """
+        Cached value for `key`, or None if absent or older than `ttl`
+        (default: self.ttl). Only entries past self.ttl are evicted, so a
+        caller with a shorter `ttl` does not drop them for everyone else.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            stored_at, value = item
+            age = datetime.utcnow() - stored_at
+            if self.ttl is not None and age > self.ttl:
+                del self._data[key]
+                return None
+            if ttl is not None and age > ttl:
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: dict) -> None:
+        with self._lock:
+            self._data[key] = (datetime.utcnow(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def _default_ttl() -> timedelta:
+    return timedelta(days=float(os.getenv("CLASSIFICATION_CACHE_TTL_DAYS", "30")))
+
+
+def _prune_interval() -> float:
+    return float(os.getenv("CLASSIFICATION_CACHE_PRUNE_INTERVAL_SECONDS", "3600"))
+
+
+# Shared by every ClassificationCache in the process (Streamlit reruns, daemon polls)
+_process_lru = LRUCache(
+    max_entries=int(os.getenv("CLASSIFICATION_CACHE_SIZE", "1024")),
+    ttl=_default_ttl(),
+)
+
+# time.monotonic() of this process's last table prune (None = not yet)
+_last_prune: Optional[float] = None
+_prune_lock = threading.Lock()
+
+
+def _prune_due() -> bool:
+    """True at most once per prune interval per process (first call included)."""
+    global _last_prune
+    now = time.monotonic()
+    with _prune_lock:
+        if _last_prune is not None and now - _last_prune < _prune_interval():
+            return False
+        _last_prune = now
+        return True
+
+
+class ClassificationCache:
+    """
+    Two-level cache of AI classification results:
+    - process-wide in-memory LRU in front
+    - persistent `classification_cache` table in PostgreSQL behind it
+
+    Entries older than `ttl` are ignored at both levels. The table is pruned
+    of them and capped at `max_rows` (least recently used rows first) on
+    the first write of a process and then at most once per
+    CLASSIFICATION_CACHE_PRUNE_INTERVAL_SECONDS (default 3600), not on
+    every batch.
+    Hit/miss counters are kept per instance (see stats()).
+    """
+
+    def __init__(
+        self,
+        storage: Optional[Storage] = None,
+        memory: Optional[LRUCache] = None,
+        ttl: Optional[timedelta] = None,
+        max_rows: Optional[int] = None,
+    ):
+        self.storage = storage
+        self.memory = memory if memory is not None else _process_lru
+        self.ttl = ttl if ttl is not None else _default_ttl()
+        self.max_rows = (
+            max_rows
+            if max_rows is not None
+            else int(os.getenv("CLASSIFICATION_CACHE_MAX_ROWS", "50000"))
+        )
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: List[str]) -> Dict[str, dict]:
+        """Return {key: result} for every key found in memory or PostgreSQL."""
+        found: Dict[str, dict] = {}
+        missing: List[str] = []
+        for key in dict.fromkeys(keys):
+            value = self.memory.get(key, ttl=self.ttl)
+            if value is not None:
+                found[key] = value
+            else:
+                missing.append(key)
+        memory_hits = len(found)
+
+        db_found: Dict[str, dict] = {}
+        if missing and self.storage is not None:
+            db_found = self.storage.get_cached_classifications(missing, max_age=self.ttl)
+            for key, value in db_found.items():
+                self.memory.put(key, value)
+            found.update(db_found)
+
+        with self._lock:
+            self.memory_hits += memory_hits
+            self.db_hits += len(db_found)
+            self.misses += len(missing) - len(db_found)
+        return found
+
+    def get(self, key: str) -> Optional[dict]:
+        return self.get_many([key]).get(key)
+
+    def put_many(self, results: Dict[str, dict]) -> None:
+        """Store fresh classification results in both levels."""
+        if not results:
+            return
+        for key, value in results.items():
+            self.memory.put(key, value)
+        if self.storage is not None:
+            self.storage.save_cached_classifications(results, model=MODEL)
+            if _prune_due():
+                self.storage.prune_classification_cache(max_age=self.ttl, max_rows=self.max_rows)
+
+    def put(self, key: str, value: dict) -> None:
+        self.put_many({key: value})
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            hits = self.memory_hits + self.db_hits
+            lookups = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
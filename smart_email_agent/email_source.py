@@ -1,7 +1,38 @@
 # smart_email_agent/email_source.py
 
-from typing import List, Dict, Protocol, runtime_checkable
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from typing import Iterator, List, Dict, Optional, Protocol, Tuple, runtime_checkable
+import hashlib
+import logging
 import os
+import threading
+import time
+
+from .rate_limit import get_limiter, is_retryable, is_throttle
+from .storage import DEFAULT_ACCOUNT, Storage
+
+logger = logging.getLogger(__name__)
+
+
+def _is_not_found(exc: Exception) -> bool:
+    """A 404 from Gmail: the message was deleted after it was listed."""
+    return getattr(getattr(exc, "resp", None), "status", None) == 404
+
+
+@dataclass
+class LabelUpdateResult:
+    """Outcome of a bulk label change: IDs updated, plus each failed chunk."""
+    modified: List[str] = field(default_factory=list)
+    failures: List[Tuple[List[str], Exception]] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.failures
+
+    @property
+    def failed_ids(self) -> List[str]:
+        return [msg_id for chunk, _ in self.failures for msg_id in chunk]
 
 
 @runtime_checkable
@@ -15,10 +46,138 @@ class EmailSource(Protocol):
         - sender: str
         - subject: str
         - body: str
+        - headers: dict (optional) of lower-cased header name -> value,
+          limited to the ones the pre-classifier uses
+        - thread_id, message_id, in_reply_to: str (optional) conversation
+          identifiers used for thread-aware triage
+        - internal_date: str (optional) epoch milliseconds, orders a thread
         """
         ...
 
 
+# ============================================================
+# Gmail credentials + service cache
+# ============================================================
+
+class GmailServiceCache:
+    """
+    Process-wide holder for Gmail OAuth credentials and the built API client.
+
+    - token.pickle is read once, not on every call
+    - credentials are refreshed only when they expire within REFRESH_MARGIN
+    - build("gmail", "v1") runs once; every request gets its own
+      AuthorizedHttp, so the shared service is safe to use from many threads
+    """
+
+    SCOPES = ["https://www.googleapis.com/auth/gmail.modify"]
+    REFRESH_MARGIN = timedelta(minutes=5)
+
+    def __init__(self, token_path: str = "token.pickle", cred_path: str = "credentials.json"):
+        self.token_path = token_path
+        self.cred_path = cred_path
+        self._lock = threading.RLock()
+        self._creds = None
+        self._service = None
+
+    def _needs_refresh(self, creds) -> bool:
+        if not creds.valid:
+            return True
+        expiry = getattr(creds, "expiry", None)  # naive UTC datetime
+        return expiry is not None and expiry - datetime.utcnow() <= self.REFRESH_MARGIN
+
+    def _save_creds(self) -> None:
+        import pickle
+
+        with open(self.token_path, "wb") as token:
+            pickle.dump(self._creds, token)
+
+    def credentials(self):
+        """Return valid credentials, refreshing or re-authorizing only if needed."""
+        with self._lock:
+            if self._creds is None and os.path.exists(self.token_path):
+                import pickle
+
+                with open(self.token_path, "rb") as token:
+                    self._creds = pickle.load(token)
+
+            creds = self._creds
+            if creds is not None and not self._needs_refresh(creds):
+                return creds
+
+            if creds is not None and creds.refresh_token:
+                from google.auth.transport.requests import Request
+
+                creds.refresh(Request())
+            else:
+                from google_auth_oauthlib.flow import InstalledAppFlow
+
+                flow = InstalledAppFlow.from_client_secrets_file(self.cred_path, self.SCOPES)
+                self._creds = flow.run_local_server(port=0)
+                # New credentials object: the service must wrap the new one
+                self._service = None
+
+            self._save_creds()
+            return self._creds
+
+    def service(self):
+        """Return the shared Gmail API client, building it on first use."""
+        creds = self.credentials()
+        with self._lock:
+            if self._service is None:
+                from googleapiclient.discovery import build
+                from googleapiclient.http import HttpRequest
+                import google_auth_httplib2
+                import httplib2
+
+                def _build_request(http, *args, **kwargs):
+                    # httplib2.Http is not thread-safe: one per request
+                    new_http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+                    return HttpRequest(new_http, *args, **kwargs)
+
+                self._service = build(
+                    "gmail",
+                    "v1",
+                    http=google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http()),
+                    requestBuilder=_build_request,
+                    cache_discovery=False,
+                )
+            return self._service
+
+    def reset(self) -> None:
+        """Drop cached credentials and service (e.g. after token revocation)."""
+        with self._lock:
+            self._creds = None
+            self._service = None
+
+
+_service_caches: Dict[Tuple[str, str], GmailServiceCache] = {}
+_service_caches_lock = threading.Lock()
+
+
+def get_gmail_service_cache(
+    token_path: str = "token.pickle",
+    cred_path: str = "credentials.json",
+) -> GmailServiceCache:
+    """Return the process-wide GmailServiceCache for these credential files."""
+    key = (os.path.abspath(token_path), os.path.abspath(cred_path))
+    with _service_caches_lock:
+        cache = _service_caches.get(key)
+        if cache is None:
+            cache = GmailServiceCache(token_path=token_path, cred_path=cred_path)
+            _service_caches[key] = cache
+        return cache
+
+
+def token_path_for_account(account: str = DEFAULT_ACCOUNT) -> str:
+    """
+    OAuth token file for a mailbox: token.pickle for the default account,
+    token_<account>.pickle for the others.
+    """
+    if account == DEFAULT_ACCOUNT:
+        return "token.pickle"
+    return f"token_{account}.pickle"
+
+
 # ============================================================
 # Gmail email source (API-based)
 # ============================================================
@@ -29,94 +188,399 @@ class GmailEmailSource:
     Requires:
     - credentials.json in project root
     - token.pickle created after first OAuth auth
+      (token_<account>.pickle for a non-default `account`)
+
+    With `incremental=True` and a `storage`, only messages added since the
+    last stored Gmail historyId are fetched (falls back to a full list when
+    there is no checkpoint or it has expired).
+
+    API calls go through the shared per-user "gmail" limiter
+    (rate_limit.py): paced in quota units below Gmail's 250 units/user/second,
+    retried with backoff on 429s and transient errors.
     """
 
-    def __init__(self, user_id: str = "me", max_results: int = 20):
+    # Gmail caps a batch request at 100 calls; 50 keeps us clear of
+    # per-user concurrency throttling.
+    MAX_BATCH_SIZE = 100
+    # messages.batchModify accepts at most 1000 IDs per call.
+    MAX_MODIFY_CHUNK = 1000
+
+    # Gmail quota units per call
+    QUOTA_LIST = 5
+    QUOTA_GET = 5
+    QUOTA_HISTORY = 2
+    QUOTA_PROFILE = 1
+    QUOTA_BATCH_MODIFY = 50
+
+    def __init__(
+        self,
+        user_id: str = "me",
+        max_results: int = 20,
+        batch_size: int = 50,
+        storage: Optional[Storage] = None,
+        incremental: bool = False,
+        account: str = DEFAULT_ACCOUNT,
+    ):
         self.user_id = user_id
+        self.account = account
         self.max_results = max_results
+        self.batch_size = max(1, min(batch_size, self.MAX_BATCH_SIZE))
+        self.storage = storage
+        self.incremental = incremental
+        # historyId seen by the last get_emails(); persisted by commit_checkpoint()
+        self._pending_history_id: Optional[str] = None
+        # Shared across instances, Streamlit reruns and threads
+        self._service_cache = get_gmail_service_cache(token_path=token_path_for_account(account))
+        self.limiter = get_limiter(f"gmail:{account}:{user_id}")
+
+    @property
+    def _checkpoint_key(self) -> str:
+        return f"gmail_history_id:{self.user_id}"
 
     def _get_service(self):
-        from googleapiclient.discovery import build
-        from google_auth_oauthlib.flow import InstalledAppFlow
-        from google.auth.transport.requests import Request
-        import os.path
-        import pickle
+        return self._service_cache.service()
 
-        SCOPES = ["https://www.googleapis.com/auth/gmail.modify"]
+    def _execute(self, request, quota_units: int):
+        """Execute one Gmail API request under the rate limiter (with retries)."""
+        return self.limiter.call(request.execute, tokens=quota_units)
 
-        creds = None
-        token_path = "token.pickle"
-        cred_path = "credentials.json"
-
-        if os.path.exists(token_path):
-            with open(token_path, "rb") as token:
-                creds = pickle.load(token)
-
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(cred_path, SCOPES)
-                creds = flow.run_local_server(port=0)
-            with open(token_path, "wb") as token:
-                pickle.dump(creds, token)
-
-        service = build("gmail", "v1", credentials=creds)
-        return service
+    # messages.list returns at most 500 IDs per page
+    MAX_LIST_PAGE = 500
 
     def get_emails(self) -> List[Dict[str, str]]:
+        return [
+            e
+            for page in self.iter_email_pages(
+                page_size=self.max_results,
+                max_messages=self.max_results,
+            )
+            for e in page
+        ]
+
+    def iter_email_pages(
+        self,
+        page_size: Optional[int] = None,
+        max_messages: Optional[int] = None,
+    ) -> Iterator[List[Dict[str, str]]]:
+        """
+        Yield unread INBOX emails one page at a time (at most `page_size`
+        per page, `max_messages` in total; None = no limit), so callers
+        can process large mailboxes with bounded memory.
+        In incremental mode only messages added since the checkpoint are
+        listed (the history window is not capped by `max_messages`). Without
+        a checkpoint, one is only staged once the full list is exhausted;
+        until then later runs keep listing, so unread mail beyond
+        `max_messages` is not skipped.
+        """
         service = self._get_service()
+        page_size = max(1, min(page_size or self.batch_size, self.MAX_LIST_PAGE))
+        profile_history_id = None
+
+        if self.incremental and self.storage is not None:
+            start_history_id = self.storage.get_sync_state(self._checkpoint_key)
+            if start_history_id:
+                msg_ids = self._list_history_ids(service, start_history_id)
+                if msg_ids is not None:
+                    for start in range(0, len(msg_ids), page_size):
+                        yield self._fetch_emails(service, msg_ids[start:start + page_size])
+                    return
+
+            # No usable checkpoint: take one *before* listing so nothing
+            # arriving during the full list is skipped next time.
+            profile = self._execute(
+                service.users().getProfile(userId=self.user_id),
+                self.QUOTA_PROFILE,
+            )
+            profile_history_id = profile.get("historyId")
+
+        remaining = max_messages
+        page_token = None
+        while remaining is None or remaining > 0:
+            results = self._execute(
+                service.users().messages().list(
+                    userId=self.user_id,
+                    labelIds=["INBOX"],   # restrict to inbox
+                    q="is:unread",        # Gmail search query: only unread
+                    maxResults=page_size if remaining is None else min(page_size, remaining),
+                    pageToken=page_token,
+                ),
+                self.QUOTA_LIST,
+            )
+
+            msg_ids = [m["id"] for m in results.get("messages", [])]
+            if msg_ids:
+                yield self._fetch_emails(service, msg_ids)
+            if remaining is not None:
+                remaining -= len(msg_ids)
+
+            page_token = results.get("nextPageToken")
+            if not page_token or not msg_ids:
+                # Every unread message has been listed
+                self._pending_history_id = profile_history_id
+                break
+
+    def _fetch_emails(self, service, msg_ids: List[str]) -> List[Dict[str, str]]:
+        """Batch-fetch `msg_ids` and convert them to raw email dicts, in order."""
+        msgs = self._fetch_messages(service, msg_ids)
+        return [self._to_email_dict(msgs[i]) for i in msg_ids if i in msgs]
+
+    def _list_history_ids(self, service, start_history_id: str) -> Optional[List[str]]:
+        """
+        Return IDs of unread INBOX messages added since `start_history_id`
+        (and not deleted since), in history order, and stage the new historyId.
+        Returns None if the checkpoint is too old (Gmail answers 404).
+        """
+        from googleapiclient.errors import HttpError
 
-        results = service.users().messages().list(
-            userId=self.user_id,
-            labelIds=["INBOX"],   # restrict to inbox
-            q="is:unread",        # Gmail search query: only unread
-            maxResults=self.max_results,
-        ).execute()
-
-
-        messages = results.get("messages", [])
-        emails: List[Dict[str, str]] = []
-
-        for m in messages:
-            msg = service.users().messages().get(
-                userId=self.user_id,
-                id=m["id"],
-                format="full"
-            ).execute()
+        msg_ids: List[str] = []
+        seen = set()
+        deleted_ids = set()
+        page_token = None
+        latest_history_id = start_history_id
 
-            headers = {h["name"].lower(): h["value"] for h in msg["payload"]["headers"]}
-            sender = headers.get("from", "")
-            subject = headers.get("subject", "")
-            body = self._extract_body_text(msg)
+        while True:
+            try:
+                resp = self._execute(
+                    service.users().history().list(
+                        userId=self.user_id,
+                        startHistoryId=start_history_id,
+                        historyTypes=["messageAdded", "messageDeleted"],
+                        labelId="INBOX",
+                        pageToken=page_token,
+                    ),
+                    self.QUOTA_HISTORY,
+                )
+            except HttpError as e:
+                if getattr(e.resp, "status", None) == 404:
+                    return None
+                raise
+
+            for record in resp.get("history", []):
+                for added in record.get("messagesAdded", []):
+                    m = added["message"]
+                    if "UNREAD" in m.get("labelIds", []) and m["id"] not in seen:
+                        seen.add(m["id"])
+                        msg_ids.append(m["id"])
+                for deleted in record.get("messagesDeleted", []):
+                    deleted_ids.add(deleted["message"]["id"])
+
+            latest_history_id = resp.get("historyId", latest_history_id)
+            page_token = resp.get("nextPageToken")
+            if not page_token:
+                break
+
+        self._pending_history_id = latest_history_id
+        return [i for i in msg_ids if i not in deleted_ids]
+
+    # ---------------------------
+    # Backfill (historical mail)
+    # ---------------------------
+
+    BACKFILL_DONE = "__done__"
+
+    @staticmethod
+    def build_query(query: str = "", after: Optional[date] = None, before: Optional[date] = None) -> str:
+        """Gmail search query with an optional [after, before) date window."""
+        parts = [query.strip()] if query and query.strip() else []
+        if after is not None:
+            parts.append(f"after:{after:%Y/%m/%d}")
+        if before is not None:
+            parts.append(f"before:{before:%Y/%m/%d}")
+        return " ".join(parts)
+
+    def _backfill_key(self, query: str) -> str:
+        digest = hashlib.sha1(query.encode("utf-8")).hexdigest()[:16]
+        return f"gmail_backfill:{self.user_id}:{digest}"
+
+    def iter_backfill_pages(
+        self,
+        query: str = "",
+        after: Optional[date] = None,
+        before: Optional[date] = None,
+        page_size: Optional[int] = None,
+        restart: bool = False,
+    ) -> Iterator[List[Dict[str, str]]]:
+        """
+        Walk every page of an arbitrary Gmail search (all labels, read or
+        unread) within an optional date window, yielding raw emails per page.
 
-            emails.append({
-                "id": m["id"],
-                "sender": sender,
-                "subject": subject,
-                "body": body,
-            })
+        With a `storage`, the next page token is checkpointed each time the
+        caller asks for the next page (i.e. after it finished the previous
+        one), so an interrupted backfill resumes where it stopped. A finished
+        backfill is remembered; pass restart=True to walk it again.
+        """
+        service = self._get_service()
+        page_size = max(1, min(page_size or self.batch_size, self.MAX_LIST_PAGE))
+        q = self.build_query(query, after, before)
+        key = self._backfill_key(q)
+
+        page_token = None
+        if self.storage is not None and not restart:
+            page_token = self.storage.get_sync_state(key)
+            if page_token == self.BACKFILL_DONE:
+                return
+
+        while True:
+            results = self._execute(
+                service.users().messages().list(
+                    userId=self.user_id,
+                    q=q,
+                    maxResults=page_size,
+                    pageToken=page_token or None,
+                    includeSpamTrash=False,
+                ),
+                self.QUOTA_LIST,
+            )
+
+            msg_ids = [m["id"] for m in results.get("messages", [])]
+            if msg_ids:
+                yield self._fetch_emails(service, msg_ids)
+
+            page_token = results.get("nextPageToken")
+            if self.storage is not None:
+                self.storage.set_sync_state(key, page_token or self.BACKFILL_DONE)
+            if not page_token:
+                break
+
+    def commit_checkpoint(self) -> None:
+        """
+        Persist the historyId staged by the last get_emails().
+        Call this only once the fetched emails have been stored, so a failed
+        run re-reads the same history window next time.
+        """
+        if self.storage is None or self._pending_history_id is None:
+            return
+        self.storage.set_sync_state(self._checkpoint_key, self._pending_history_id)
+        self._pending_history_id = None
 
-        return emails
-    
-    def mark_as_read(self, email_ids: list[str]) -> None:
+    def _fetch_messages(self, service, msg_ids: List[str]) -> Dict[str, dict]:
         """
-        Mark the given Gmail message IDs as read by removing the UNREAD label.
+        Fetch full messages by ID using Gmail batch requests,
+        `batch_size` gets per HTTP round trip.
+        Sub-requests that fail with a throttle/transient error are retried
+        (with backoff) in a smaller follow-up batch. Messages deleted since
+        they were listed (404) are skipped.
+        Returns {message_id: message resource}.
+        Raises the first non-retryable (or exhausted) per-message error.
+        """
+        msgs: Dict[str, dict] = {}
+        pending = list(msg_ids)
+        attempt = 0
+
+        while pending:
+            attempt += 1
+            errors: Dict[str, Exception] = {}
+
+            def _on_response(request_id, response, exception):
+                if exception is not None:
+                    errors[request_id] = exception
+                else:
+                    msgs[request_id] = response
+
+            for start in range(0, len(pending), self.batch_size):
+                chunk = pending[start:start + self.batch_size]
+                batch = service.new_batch_http_request(callback=_on_response)
+                for msg_id in chunk:
+                    batch.add(
+                        service.users().messages().get(
+                            userId=self.user_id,
+                            id=msg_id,
+                            format="full",
+                        ),
+                        request_id=msg_id,
+                    )
+                self.limiter.call(batch.execute, tokens=self.QUOTA_GET * len(chunk))
+
+            for msg_id in [i for i, exc in errors.items() if _is_not_found(exc)]:
+                logger.info("Gmail message %s no longer exists; skipping it", msg_id)
+                del errors[msg_id]
+
+            if not errors:
+                break
+
+            if any(is_throttle(exc) for exc in errors.values()):
+                self.limiter.record_throttle()
+
+            fatal = [(i, exc) for i, exc in errors.items() if not is_retryable(exc)]
+            if fatal or attempt >= self.limiter.max_attempts:
+                msg_id, exc = fatal[0] if fatal else next(iter(errors.items()))
+                raise RuntimeError(f"Failed to fetch Gmail message {msg_id}: {exc}") from exc
+
+            pending = [i for i in pending if i in errors]
+            time.sleep(self.limiter.backoff_delay(attempt, next(iter(errors.values()))))
+
+        return msgs
+
+    # Headers passed through for the local pre-classifier (prefilter.py)
+    KEPT_HEADERS = (
+        "list-unsubscribe",
+        "list-id",
+        "precedence",
+        "auto-submitted",
+        "x-auto-response-suppress",
+    )
+
+    def _to_email_dict(self, msg: dict) -> Dict[str, str]:
+        headers = {h["name"].lower(): h["value"] for h in msg["payload"]["headers"]}
+        return {
+            "id": msg["id"],
+            "sender": headers.get("from", ""),
+            "subject": headers.get("subject", ""),
+            "body": self._extract_body_text(msg),
+            "headers": {k: headers[k] for k in self.KEPT_HEADERS if k in headers},
+            "thread_id": msg.get("threadId"),
+            "message_id": headers.get("message-id"),
+            "in_reply_to": headers.get("in-reply-to"),
+            "internal_date": msg.get("internalDate"),
+        }
+
+    def modify_labels(
+        self,
+        email_ids: List[str],
+        add_label_ids: Optional[List[str]] = None,
+        remove_label_ids: Optional[List[str]] = None,
+        chunk_size: int = MAX_MODIFY_CHUNK,
+    ) -> LabelUpdateResult:
         """
+        Add/remove labels on many messages with users.messages.batchModify,
+        one request per chunk of up to 1000 IDs.
+        A failed chunk is recorded in the result; the remaining chunks still run.
+        """
+        result = LabelUpdateResult()
         if not email_ids:
-            return
+            return result
+
+        chunk_size = max(1, min(chunk_size, self.MAX_MODIFY_CHUNK))
+        body: Dict[str, List[str]] = {}
+        if add_label_ids:
+            body["addLabelIds"] = list(add_label_ids)
+        if remove_label_ids:
+            body["removeLabelIds"] = list(remove_label_ids)
 
         service = self._get_service()
 
-        for msg_id in email_ids:
+        for start in range(0, len(email_ids), chunk_size):
+            chunk = list(email_ids[start:start + chunk_size])
             try:
-                service.users().messages().modify(
-                    userId=self.user_id,
-                    id=msg_id,
-                    body={"removeLabelIds": ["UNREAD"]},
-                ).execute()
+                self._execute(
+                    service.users().messages().batchModify(
+                        userId=self.user_id,
+                        body={"ids": chunk, **body},
+                    ),
+                    self.QUOTA_BATCH_MODIFY,
+                )
             except Exception as e:
-                print(f"[WARN] Failed to mark {msg_id} as read: {e}")
+                result.failures.append((chunk, e))
+            else:
+                result.modified.extend(chunk)
+
+        return result
+
+    def mark_as_read(self, email_ids: List[str]) -> LabelUpdateResult:
+        """
+        Mark the given Gmail message IDs as read by removing the UNREAD label.
+        """
+        return self.modify_labels(email_ids, remove_label_ids=["UNREAD"])
 
     def _extract_body_text(self, msg) -> str:
         import base64
@@ -145,11 +609,21 @@ class GmailEmailSource:
 # Default source selector (Gmail only)
 # ============================================================
 
-def get_default_email_source() -> EmailSource:
+def get_default_email_source(storage: Optional[Storage] = None) -> EmailSource:
     """
     Default email source for the whole app.
-    Always returns GmailEmailSource.
+    Always returns GmailEmailSource, for the mailbox `storage` is scoped to.
     max_results default is 20 for CLI runs.
+    Incremental historyId sync is enabled with GMAIL_INCREMENTAL_SYNC=1
+    (requires `storage` for the checkpoint).
     """
     max_results = int(os.getenv("GMAIL_MAX_RESULTS", "20"))
-    return GmailEmailSource(max_results=max_results)
+    batch_size = int(os.getenv("GMAIL_BATCH_SIZE", "50"))
+    incremental = os.getenv("GMAIL_INCREMENTAL_SYNC", "0") == "1"
+    return GmailEmailSource(
+        max_results=max_results,
+        batch_size=batch_size,
+        storage=storage,
+        incremental=incremental,
+        account=storage.account if storage is not None else DEFAULT_ACCOUNT,
+    )
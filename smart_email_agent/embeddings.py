@@ -0,0 +1,205 @@
+# smart_email_agent/embeddings.py
+
+# Local, CPU-only email embeddings for "emails like this one" and
+# near-duplicate grouping. A signed feature-hashing vectorizer over word
+# unigrams/bigrams of the subject, sender domain and body: no model download,
+# deterministic across processes, ~1ms per email. Vectors are L2-normalized
+# float32, so cosine similarity is a dot product. NumPy is used for top-k
+# lookups when installed; otherwise a pure-Python scan is used.
+
+import hashlib
+import heapq
+import math
+import re
+import threading
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:  # optional: vectorized top-k
+    import numpy as np
+except ImportError:  # pragma: no cover - depends on the environment
+    np = None
+
+# Changing the dimension or features invalidates stored vectors
+EMBEDDING_DIM = 256
+EMBEDDING_VERSION = 1
+
+# Cosine similarity above which two emails count as near-duplicates
+DEFAULT_DUPLICATE_THRESHOLD = 0.85
+
+# Body characters considered (signatures/long footers add little signal)
+_MAX_BODY_CHARS = 4000
+
+_WORD_RE = re.compile(r"[a-z0-9][a-z0-9'_-]*[a-z0-9]|[a-z0-9]")
+_URL_RE = re.compile(r"https?://\S+", re.IGNORECASE)
+_DIGITS_RE = re.compile(r"\d")
+_QUOTED_LINE_RE = re.compile(r"^\s*>.*$", re.MULTILINE)
+_STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have i if in is it its of on or our so "
+    "that the this to was we were will with you your".split()
+)
+
+
+# ---------------------------
+# Vectorizer
+# ---------------------------
+
+def _tokens(text: str) -> List[str]:
+    text = _URL_RE.sub(" ", text.lower())
+    # Order/ticket numbers differ between otherwise identical notifications
+    text = _DIGITS_RE.sub("0", text)
+    return [w for w in _WORD_RE.findall(text) if w not in _STOPWORDS]
+
+
+def _features(subject: str, body: str, sender: str) -> Counter:
+    features: Counter = Counter()
+    subject_tokens = _tokens(subject or "")
+    body_tokens = _tokens(_QUOTED_LINE_RE.sub("", (body or "")[:_MAX_BODY_CHARS]))
+
+    for tokens, prefix, weight in ((subject_tokens, "s", 2.0), (body_tokens, "b", 1.0)):
+        for tok in tokens:
+            features[tok] += weight
+        for a, b in zip(tokens, tokens[1:]):
+            features[f"{prefix}:{a} {b}"] += weight
+
+    domain = (sender or "").rsplit("@", 1)[-1].strip(" >").lower()
+    if domain:
+        features[f"domain:{domain}"] += 2.0
+    return features
+
+
+def _bucket(feature: str) -> Tuple[int, float]:
+    digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+    value = int.from_bytes(digest, "little")
+    return value % EMBEDDING_DIM, (1.0 if (value >> 63) & 1 else -1.0)
+
+
+def embed_text(subject: str, body: str, sender: str = "") -> List[float]:
+    """Hash an email into a unit-length EMBEDDING_DIM vector (all zeros if empty)."""
+    vec = [0.0] * EMBEDDING_DIM
+    for feature, count in _features(subject, body, sender).items():
+        index, sign = _bucket(feature)
+        vec[index] += sign * (1.0 + math.log(count))  # sublinear tf
+
+    norm = math.sqrt(sum(v * v for v in vec))
+    if norm == 0.0:
+        return vec
+    return [v / norm for v in vec]
+
+
+def pack_vector(vec: Sequence[float]) -> bytes:
+    """float32 little-endian bytes (4 * EMBEDDING_DIM) for a BYTEA column."""
+    arr = array("f", vec)
+    if arr.itemsize != 4:  # pragma: no cover - exotic platforms
+        raise RuntimeError("float32 arrays are required for embeddings")
+    return arr.tobytes()
+
+
+def unpack_vector(blob: bytes) -> array:
+    arr = array("f")
+    arr.frombytes(bytes(blob))
+    return arr
+
+
+def cosine(a: Sequence[float], b: Sequence[float]) -> float:
+    """Cosine similarity of two unit vectors."""
+    return sum(x * y for x, y in zip(a, b))
+
+
+# ---------------------------
+# In-memory index
+# ---------------------------
+
+class EmbeddingIndex:
+    """
+    Exact top-k cosine search over one account's vectors.
+    Rows are appended incrementally (see Storage.similar_emails) and kept
+    as one float32 matrix when NumPy is available.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._ids: List[str] = []
+        self._positions: Dict[str, int] = {}
+        self._vectors: List[array] = []
+        self._matrix = None  # lazily rebuilt NumPy matrix
+        # processed_at of the newest row loaded from storage
+        self.watermark = None
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, email_id: str) -> bool:
+        return email_id in self._positions
+
+    def add(self, rows: Iterable[Tuple[str, bytes]]) -> int:
+        """Add (email_id, packed vector) rows; known ids are skipped."""
+        added = 0
+        with self._lock:
+            for email_id, blob in rows:
+                if email_id in self._positions or not blob:
+                    continue
+                self._positions[email_id] = len(self._ids)
+                self._ids.append(email_id)
+                self._vectors.append(unpack_vector(blob))
+                added += 1
+            if added:
+                self._matrix = None
+        return added
+
+    def vector(self, email_id: str) -> Optional[array]:
+        pos = self._positions.get(email_id)
+        return self._vectors[pos] if pos is not None else None
+
+    def top_k(
+        self,
+        query: Sequence[float],
+        k: int,
+        exclude: Iterable[str] = (),
+        min_similarity: float = 0.0,
+    ) -> List[Tuple[str, float]]:
+        """The `k` most similar ids with their cosine similarity, best first."""
+        excluded = set(exclude)
+        with self._lock:
+            ids = self._ids
+            if not ids or k <= 0:
+                return []
+            if np is not None:
+                if self._matrix is None:
+                    self._matrix = np.frombuffer(
+                        b"".join(v.tobytes() for v in self._vectors), dtype="<f4"
+                    ).reshape(len(ids), EMBEDDING_DIM)
+                scores = self._matrix @ np.asarray(query, dtype="<f4")
+                n = min(len(ids), k + len(excluded))
+                top = np.argpartition(-scores, n - 1)[:n]
+                candidates = [(ids[i], float(scores[i])) for i in top]
+            else:
+                candidates = [(email_id, cosine(query, vec)) for email_id, vec in zip(ids, self._vectors)]
+
+        best = heapq.nlargest(
+            k,
+            (c for c in candidates if c[0] not in excluded and c[1] >= min_similarity),
+            key=lambda c: c[1],
+        )
+        return best
+
+
+def group_near_duplicates(
+    items: Sequence[Tuple[str, Sequence[float]]],
+    threshold: float = DEFAULT_DUPLICATE_THRESHOLD,
+) -> List[List[str]]:
+    """
+    Greedy single-pass grouping, in input order: each item joins the first
+    group whose leader is at least `threshold` similar, else starts a group.
+    Returns groups of ids (singletons included), leaders first.
+    """
+    groups: List[Tuple[Sequence[float], List[str]]] = []
+    for email_id, vec in items:
+        for leader, members in groups:
+            if cosine(leader, vec) >= threshold:
+                members.append(email_id)
+                break
+        else:
+            groups.append((vec, [email_id]))
+    return [members for _, members in groups]
@@ -0,0 +1,271 @@
+# smart_email_agent/migrations.py
+
+# Ordered schema migrations for the PostgreSQL store. Applied versions are
+# recorded in `schema_version`; Storage only checks the latest version on a
+# cold start (see Storage.migrate()). Never edit a released migration:
+# append a new one with the next version. Steps are idempotent
+# (IF NOT EXISTS), so databases created by the old on-startup DDL can be
+# migrated from version 0.
+
+from dataclasses import dataclass
+from typing import List
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    statements: List[str]
+
+
+# Key for pg_advisory_xact_lock: serializes concurrent migrators
+MIGRATION_LOCK_ID = 0x1B0C5_1E7E
+
+SCHEMA_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version     INTEGER PRIMARY KEY,
+    description TEXT NOT NULL,
+    applied_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(
+        1,
+        "emails and tasks tables",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS emails (
+                email_id     TEXT PRIMARY KEY,
+                sender       TEXT,
+                subject      TEXT,
+                body         TEXT,
+                urgency      TEXT,
+                category     TEXT,
+                summary      TEXT,
+                processed_at TIMESTAMPTZ
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS tasks (
+                id          SERIAL PRIMARY KEY,
+                email_id    TEXT REFERENCES emails(email_id) ON DELETE CASCADE,
+                description TEXT,
+                due_date    TIMESTAMPTZ,
+                created_at  TIMESTAMPTZ
+            );
+            """,
+        ],
+    ),
+    Migration(
+        2,
+        "archive indexes",
+        [
+            "CREATE INDEX IF NOT EXISTS idx_tasks_email_id ON tasks (email_id);",
+            # Keyset pagination over the archive (newest first)
+            "CREATE INDEX IF NOT EXISTS idx_emails_processed_at "
+            "ON emails (processed_at DESC, email_id DESC);",
+            # Dashboard aggregates and archive filters
+            "CREATE INDEX IF NOT EXISTS idx_emails_urgency ON emails (urgency);",
+            "CREATE INDEX IF NOT EXISTS idx_emails_category ON emails (category);",
+        ],
+    ),
+    Migration(
+        3,
+        "pre-classifier routing columns",
+        [
+            "ALTER TABLE emails ADD COLUMN IF NOT EXISTS classified_by TEXT DEFAULT 'ai';",
+            "ALTER TABLE emails ADD COLUMN IF NOT EXISTS prefilter_score REAL;",
+        ],
+    ),
+    Migration(
+        4,
+        "sync checkpoints",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS sync_state (
+                key        TEXT PRIMARY KEY,
+                value      TEXT,
+                updated_at TIMESTAMPTZ
+            );
+            """,
+        ],
+    ),
+    Migration(
+        5,
+        "classification cache",
+        [
+            # Keyed by content hash (see classification_cache.py)
+            """
+            CREATE TABLE IF NOT EXISTS classification_cache (
+                cache_key    TEXT PRIMARY KEY,
+                result       JSONB NOT NULL,
+                model        TEXT,
+                created_at   TIMESTAMPTZ NOT NULL,
+                last_used_at TIMESTAMPTZ NOT NULL,
+                hit_count    INTEGER NOT NULL DEFAULT 0
+            );
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_classification_cache_last_used "
+            "ON classification_cache (last_used_at);",
+        ],
+    ),
+    Migration(
+        6,
+        "triage job queue",
+        [
+            # pending -> in_progress -> done | failed
+            """
+            CREATE TABLE IF NOT EXISTS triage_jobs (
+                email_id     TEXT PRIMARY KEY,
+                seq          BIGSERIAL,
+                payload      JSONB NOT NULL,
+                state        TEXT NOT NULL DEFAULT 'pending'
+                             CHECK (state IN ('pending', 'in_progress', 'done', 'failed')),
+                attempts     INTEGER NOT NULL DEFAULT 0,
+                last_error   TEXT,
+                locked_by    TEXT,
+                locked_at    TIMESTAMPTZ,
+                available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                created_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+                updated_at   TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_triage_jobs_claim "
+            "ON triage_jobs (state, available_at, seq);",
+        ],
+    ),
+    Migration(
+        7,
+        "multi-account keys and account leases",
+        [
+            # Mailbox ownership for multi-worker runs (see worker.py)
+            """
+            CREATE TABLE IF NOT EXISTS account_leases (
+                account     TEXT PRIMARY KEY,
+                owner       TEXT,
+                expires_at  TIMESTAMPTZ,
+                last_run_at TIMESTAMPTZ
+            );
+            """,
+            "ALTER TABLE emails ADD COLUMN IF NOT EXISTS account TEXT NOT NULL DEFAULT 'default';",
+            "ALTER TABLE tasks ADD COLUMN IF NOT EXISTS account TEXT NOT NULL DEFAULT 'default';",
+            "ALTER TABLE sync_state ADD COLUMN IF NOT EXISTS account TEXT NOT NULL DEFAULT 'default';",
+            "ALTER TABLE triage_jobs ADD COLUMN IF NOT EXISTS account TEXT NOT NULL DEFAULT 'default';",
+            # Re-key by (account, id); skipped where an earlier build already did
+            """
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_constraint
+                    WHERE conname = 'emails_pkey' AND array_length(conkey, 1) = 2
+                ) THEN
+                    ALTER TABLE tasks DROP CONSTRAINT IF EXISTS tasks_email_id_fkey;
+                    ALTER TABLE emails DROP CONSTRAINT emails_pkey;
+                    ALTER TABLE emails ADD PRIMARY KEY (account, email_id);
+                    ALTER TABLE tasks ADD CONSTRAINT tasks_account_email_id_fkey
+                        FOREIGN KEY (account, email_id)
+                        REFERENCES emails (account, email_id) ON DELETE CASCADE;
+                END IF;
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_constraint
+                    WHERE conname = 'sync_state_pkey' AND array_length(conkey, 1) = 2
+                ) THEN
+                    ALTER TABLE sync_state DROP CONSTRAINT sync_state_pkey;
+                    ALTER TABLE sync_state ADD PRIMARY KEY (account, key);
+                END IF;
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_constraint
+                    WHERE conname = 'triage_jobs_pkey' AND array_length(conkey, 1) = 2
+                ) THEN
+                    ALTER TABLE triage_jobs DROP CONSTRAINT triage_jobs_pkey;
+                    ALTER TABLE triage_jobs ADD PRIMARY KEY (account, email_id);
+                END IF;
+            END $$;
+            """,
+            "DROP INDEX IF EXISTS idx_tasks_email_id;",
+            "DROP INDEX IF EXISTS idx_emails_processed_at;",
+            "DROP INDEX IF EXISTS idx_triage_jobs_claim;",
+            "CREATE INDEX IF NOT EXISTS idx_tasks_account_email_id ON tasks (account, email_id);",
+            # Keyset pagination over one account's archive (newest first)
+            "CREATE INDEX IF NOT EXISTS idx_emails_account_processed_at "
+            "ON emails (account, processed_at DESC, email_id DESC);",
+            "CREATE INDEX IF NOT EXISTS idx_triage_jobs_account_claim "
+            "ON triage_jobs (account, state, available_at, seq);",
+        ],
+    ),
+    Migration(
+        8,
+        "full-text search vector",
+        [
+            # Weighted so subject hits outrank sender/summary hits, which
+            # outrank body hits. The body is capped to stay well under
+            # tsvector's 1MB limit.
+            """
+            ALTER TABLE emails ADD COLUMN IF NOT EXISTS search_vector tsvector
+            GENERATED ALWAYS AS (
+                setweight(to_tsvector('english', COALESCE(subject, '')), 'A')
+                || setweight(to_tsvector('english', COALESCE(sender, '')), 'B')
+                || setweight(to_tsvector('english', COALESCE(summary, '')), 'B')
+                || setweight(to_tsvector('english', LEFT(COALESCE(body, ''), 100000)), 'C')
+            ) STORED;
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_emails_search ON emails USING GIN (search_vector);",
+        ],
+    ),
+    Migration(
+        9,
+        "local embeddings",
+        [
+            # float32 vectors from embeddings.py (4 * EMBEDDING_DIM bytes);
+            # NULL / older versions are filled by Storage.backfill_embeddings()
+            "ALTER TABLE emails ADD COLUMN IF NOT EXISTS embedding BYTEA;",
+            "ALTER TABLE emails ADD COLUMN IF NOT EXISTS embedding_version SMALLINT;",
+        ],
+    ),
+    Migration(
+        10,
+        "thread identifiers",
+        [
+            "ALTER TABLE emails ADD COLUMN IF NOT EXISTS thread_id TEXT;",
+            "ALTER TABLE emails ADD COLUMN IF NOT EXISTS message_id TEXT;",
+            "ALTER TABLE emails ADD COLUMN IF NOT EXISTS in_reply_to TEXT;",
+            # Latest classified message per thread (thread-aware triage)
+            "CREATE INDEX IF NOT EXISTS idx_emails_thread "
+            "ON emails (account, thread_id, processed_at DESC) WHERE thread_id IS NOT NULL;",
+        ],
+    ),
+    Migration(
+        11,
+        "drop payloads of finished triage jobs",
+        [
+            # Done jobs keep only their key (dedup); the email lives in `emails`
+            "ALTER TABLE triage_jobs ALTER COLUMN payload DROP NOT NULL;",
+            "UPDATE triage_jobs SET payload = NULL WHERE state = 'done';",
+        ],
+    ),
+    Migration(
+        12,
+        "order threads by received time",
+        [
+            "ALTER TABLE emails ADD COLUMN IF NOT EXISTS internal_date BIGINT;",
+            # Latest message per thread by when it arrived, not when it was triaged
+            "DROP INDEX IF EXISTS idx_emails_thread;",
+            "CREATE INDEX IF NOT EXISTS idx_emails_thread "
+            "ON emails (account, thread_id, internal_date DESC NULLS LAST, processed_at DESC) "
+            "WHERE thread_id IS NOT NULL;",
+        ],
+    ),
+    Migration(
+        13,
+        "classification cache age index",
+        [
+            # TTL pruning deletes by created_at
+            "CREATE INDEX IF NOT EXISTS idx_classification_cache_created "
+            "ON classification_cache (created_at);",
+        ],
+    ),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
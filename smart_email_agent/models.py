@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import List
+from typing import List, Optional
 
 @dataclass
 class ProcessedEmail:
@@ -12,4 +12,10 @@ class ProcessedEmail:
     tasks: List[str]
     summary: str = ""       # 👈 NEW
     reply_draft: str = ""
+    classified_by: str = "ai"   # "ai", "prefilter" (local rules, no API call) or "thread"
+    prefilter_score: Optional[float] = None
+    thread_id: Optional[str] = None     # Gmail threadId
+    message_id: Optional[str] = None    # RFC 5322 Message-ID header
+    in_reply_to: Optional[str] = None
+    internal_date: Optional[int] = None  # Gmail internalDate (ms since epoch): when it was received
 
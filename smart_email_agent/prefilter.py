@@ -0,0 +1,188 @@
+# smart_email_agent/prefilter.py
+
+# Cheap local first-stage classifier: routes obvious promo / automated mail
+# (newsletters, receipts, no-reply notifications) straight to a
+# ProcessedEmail without calling the model. Mail without at least one
+# bulk/automation header signal is never routed here, and header signals
+# alone never clear the threshold: the content has to look like promo /
+# automated mail too (mailing lists also carry actionable mail).
+
+import math
+import os
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from .models import ProcessedEmail
+
+# ---------------------------
+# Model weights
+# ---------------------------
+
+_BIAS = -3.0
+
+# Header signals: (promo weight, automated weight)
+_HEADER_WEIGHTS: Dict[str, tuple] = {
+    "list_unsubscribe": (2.5, 1.0),
+    "list_id": (1.5, 0.5),
+    "precedence_bulk": (1.5, 1.5),
+    "auto_submitted": (0.0, 3.0),
+    "auto_response_suppress": (0.0, 1.5),
+    "noreply_sender": (1.0, 2.5),
+    "marketing_sender": (2.0, 0.0),
+}
+
+# Header weight is capped so headers alone stay below the default threshold
+# (sigmoid(_BIAS + 4.5) ~= 0.82); content has to supply the rest
+_MAX_HEADER_WEIGHT = 4.5
+
+# Net content weight (promo/automated tokens minus actionable ones) needed
+# before an email can be routed at all, whatever the threshold
+_MIN_CONTENT_WEIGHT = 0.8
+
+_PROMO_TOKENS: Dict[str, float] = {
+    "unsubscribe": 0.8, "sale": 0.6, "off": 0.3, "offer": 0.5, "offers": 0.5,
+    "deal": 0.5, "deals": 0.5, "discount": 0.6, "coupon": 0.7, "promo": 0.7,
+    "newsletter": 0.8, "shop": 0.4, "free": 0.3, "exclusive": 0.4, "limited": 0.3,
+    "subscribe": 0.4, "webinar": 0.4, "save": 0.2, "new": 0.1, "%": 0.4,
+}
+
+_AUTOMATED_TOKENS: Dict[str, float] = {
+    "receipt": 0.8, "order": 0.5, "invoice": 0.5, "shipped": 0.7, "delivery": 0.4,
+    "tracking": 0.5, "notification": 0.6, "verify": 0.6, "verification": 0.7,
+    "code": 0.3, "password": 0.5, "reset": 0.4, "login": 0.4, "sign-in": 0.5,
+    "alert": 0.4, "automated": 0.8, "automatically": 0.6, "do-not-reply": 0.8,
+    "statement": 0.4, "confirmation": 0.6, "confirmed": 0.4, "payment": 0.3,
+}
+
+# Actionable / personal wording, subtracted from both categories: mail
+# that asks for something belongs with the model
+_ACTION_TOKENS: Dict[str, float] = {
+    "please": 0.3, "review": 0.8, "approve": 0.8, "approval": 0.8, "urgent": 1.0,
+    "asap": 1.0, "deadline": 0.8, "today": 0.5, "tonight": 0.6, "tomorrow": 0.5,
+    "outage": 1.0, "incident": 0.8, "moved": 0.5, "rescheduled": 0.6, "cancel": 0.5,
+    "cancelled": 0.5, "canceled": 0.5, "exam": 0.8, "meeting": 0.6, "dispute": 0.8,
+    "broken": 0.6, "question": 0.5, "help": 0.3,
+}
+
+# Counts above this add nothing (keeps long newsletters from dominating)
+_MAX_TOKEN_COUNT = 3
+
+_TOKEN_RE = re.compile(r"[a-z][a-z\-]+|%")
+_NOREPLY_RE = re.compile(
+    r"(no-?reply|do-?not-?reply|mailer-daemon|bounce|automated)@",
+    re.IGNORECASE,
+)
+_MARKETING_RE = re.compile(r"(newsletter|news|marketing|promo|offers|deals)@", re.IGNORECASE)
+
+
+def get_default_threshold() -> float:
+    """
+    Confidence needed to skip the model.
+    Configurable via PREFILTER_THRESHOLD (default 0.9).
+    """
+    return float(os.getenv("PREFILTER_THRESHOLD", "0.9"))
+
+
+def prefilter_enabled() -> bool:
+    """The pre-classifier runs unless PREFILTER=0."""
+    return os.getenv("PREFILTER", "1") != "0"
+
+
+@dataclass
+class PrefilterDecision:
+    category: str  # "promo" or "automated"
+    confidence: float
+    signals: List[str] = field(default_factory=list)
+
+
+def _header_signals(email: Dict) -> List[str]:
+    headers = {k.lower(): (v or "") for k, v in (email.get("headers") or {}).items()}
+    signals: List[str] = []
+
+    if headers.get("list-unsubscribe"):
+        signals.append("list_unsubscribe")
+    if headers.get("list-id"):
+        signals.append("list_id")
+    if headers.get("precedence", "").strip().lower() in {"bulk", "list", "junk"}:
+        signals.append("precedence_bulk")
+    auto_submitted = headers.get("auto-submitted", "").strip().lower()
+    if auto_submitted and auto_submitted != "no":
+        signals.append("auto_submitted")
+    if headers.get("x-auto-response-suppress"):
+        signals.append("auto_response_suppress")
+
+    sender = email.get("sender", "")
+    if _NOREPLY_RE.search(sender):
+        signals.append("noreply_sender")
+    elif _MARKETING_RE.search(sender):
+        signals.append("marketing_sender")
+    return signals
+
+
+def _sigmoid(x: float) -> float:
+    return 1.0 / (1.0 + math.exp(-x))
+
+
+def score_email(email: Dict) -> Optional[PrefilterDecision]:
+    """
+    Score a raw email dict (id, sender, subject, body, optional headers).
+    Returns the more likely of promo/automated with its confidence, or None
+    if there is no header signal or not enough promo/automated content.
+    """
+    signals = _header_signals(email)
+    if not signals:
+        return None
+
+    counts = Counter(
+        _TOKEN_RE.findall(f"{email.get('subject', '')}\n{email.get('body', '')}".lower())
+    )
+
+    def weight(token_weights: Dict[str, float]) -> float:
+        return sum(w * min(counts[t], _MAX_TOKEN_COUNT) for t, w in token_weights.items())
+
+    action = weight(_ACTION_TOKENS)
+    scores, content = {}, {}
+    for idx, (category, token_weights) in enumerate(
+        (("promo", _PROMO_TOKENS), ("automated", _AUTOMATED_TOKENS))
+    ):
+        content[category] = weight(token_weights) - action
+        header = min(sum(_HEADER_WEIGHTS[s][idx] for s in signals), _MAX_HEADER_WEIGHT)
+        scores[category] = _BIAS + header + content[category]
+
+    category = max(scores, key=scores.get)
+    if content[category] < _MIN_CONTENT_WEIGHT:
+        return None
+    return PrefilterDecision(
+        category=category,
+        confidence=_sigmoid(scores[category]),
+        signals=signals,
+    )
+
+
+def prefilter_email(email: Dict, threshold: Optional[float] = None) -> Optional[ProcessedEmail]:
+    """
+    Return a ProcessedEmail for a high-confidence promo/automated email,
+    or None if it should go to the AI classifier.
+    """
+    if threshold is None:
+        threshold = get_default_threshold()
+
+    decision = score_email(email)
+    if decision is None or decision.confidence < threshold:
+        return None
+
+    return ProcessedEmail(
+        id=email["id"],
+        sender=email["sender"],
+        subject=email["subject"],
+        body=email["body"],
+        urgency="low",
+        category=decision.category,
+        tasks=[],
+        summary=f"{decision.category.capitalize()} email: {email['subject']}".strip(),
+        reply_draft="",
+        classified_by="prefilter",
+        prefilter_score=round(decision.confidence, 4),
+    )
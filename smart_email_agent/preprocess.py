@@ -0,0 +1,171 @@
+# smart_email_agent/preprocess.py
+
+import os
+import re
+from typing import Dict, List, Optional
+
+from .ai_classifier import estimate_tokens
+
+# ---------------------------
+# Patterns
+# ---------------------------
+
+# Start of a quoted reply chain: everything from here on is history
+_REPLY_HEADER_RES = [
+    re.compile(r"^\s*On .{0,200}wrote:\s*$", re.IGNORECASE),
+    re.compile(r"^\s*-{2,}\s*Original Message\s*-{2,}\s*$", re.IGNORECASE),
+    re.compile(r"^\s*-{2,}\s*Forwarded message\s*-{2,}\s*$", re.IGNORECASE),
+]
+
+# Outlook separator line: only a reply boundary when a "From:" header follows
+# (forms and plain-text tables use underscore rules too)
+_OUTLOOK_SEPARATOR_RE = re.compile(r"^\s*_{10,}\s*$")
+
+# Outlook-style quoted header block: "From: ..." followed by "Sent:"/"Date:"
+_OUTLOOK_FROM_RE = re.compile(r"^\s*From:\s.+$", re.IGNORECASE)
+_OUTLOOK_SENT_RE = re.compile(r"^\s*(Sent|Date):\s", re.IGNORECASE)
+
+# Start of a signature / footer: everything from here on is boilerplate
+_SIGNATURE_RES = [
+    re.compile(r"^--\s?$"),
+    re.compile(r"^\s*Sent from my \w+", re.IGNORECASE),
+    re.compile(r"^\s*Get Outlook for \w+", re.IGNORECASE),
+]
+
+# Footer lines that are legal / marketing boilerplate. Only matched in the
+# trailing footer block (see strip_boilerplate): "unsubscribe" in the body
+# of a support request is content.
+_BOILERPLATE_LINE_RES = [
+    re.compile(r"unsubscribe", re.IGNORECASE),
+    re.compile(r"manage (your )?(email )?preferences", re.IGNORECASE),
+    re.compile(r"view (this email )?in (your )?browser", re.IGNORECASE),
+    re.compile(r"(this|the) (e-?mail|message).{0,80}(confidential|intended (solely )?for)", re.IGNORECASE),
+    re.compile(r"if you (are not|have received this).{0,40}(intended recipient|in error)", re.IGNORECASE),
+]
+
+# Footer lines are short; longer lines are treated as content
+_MAX_FOOTER_LINE_CHARS = 240
+
+_QUOTED_LINE_RE = re.compile(r"^\s*>")
+_URL_RE = re.compile(r"https?://([^/\s?#]+)[^\s]*", re.IGNORECASE)
+_INVISIBLE_RE = re.compile("[\u200b\u200c\u200d\u2060\ufeff\u00ad\u034f]")
+_SPACES_RE = re.compile(r"[ \t\f\v\u00a0]+")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+TRUNCATION_MARKER = "\n[... truncated]"
+
+
+def get_default_body_token_budget() -> int:
+    """
+    Max estimated tokens of email body sent to the classifier.
+    Configurable via AI_BODY_TOKEN_BUDGET (default 1500; 0 disables truncation).
+    """
+    return max(0, int(os.getenv("AI_BODY_TOKEN_BUDGET", "1500")))
+
+
+# ---------------------------
+# Stages
+# ---------------------------
+
+def _cut_at_first(lines: List[str], patterns) -> List[str]:
+    for i, line in enumerate(lines):
+        # Never cut at the very top: a body that *starts* with "From:" etc.
+        # is content, not a trailing quote.
+        if i > 0 and any(p.search(line) for p in patterns):
+            return lines[:i]
+    return lines
+
+
+def strip_quoted_history(text: str) -> str:
+    """Drop "> quoted" lines and everything after a reply/forward header."""
+    lines = [l for l in text.split("\n") if not _QUOTED_LINE_RE.match(l)]
+    lines = _cut_at_first(lines, _REPLY_HEADER_RES)
+    for i in range(1, len(lines) - 1):
+        if _OUTLOOK_FROM_RE.match(lines[i]) and _OUTLOOK_SENT_RE.match(lines[i + 1]):
+            return "\n".join(lines[:i])
+        if _OUTLOOK_SEPARATOR_RE.match(lines[i]):
+            following = next((l for l in lines[i + 1:] if l.strip()), "")
+            if _OUTLOOK_FROM_RE.match(following):
+                return "\n".join(lines[:i])
+    return "\n".join(lines)
+
+
+def _is_footer_line(line: str) -> bool:
+    return len(line) <= _MAX_FOOTER_LINE_CHARS and any(
+        p.search(line) for p in _BOILERPLATE_LINE_RES
+    )
+
+
+def _strip_footer_block(lines: List[str]) -> List[str]:
+    """
+    Drop boilerplate lines from the trailing paragraphs. Walking back from
+    the end, a paragraph belongs to the footer if it has a boilerplate line
+    and all its lines are short; the first paragraph that does not ends
+    the footer. The first paragraph is always kept.
+    """
+    paragraphs: List[List[str]] = [[]]
+    for line in lines:
+        if line.strip():
+            paragraphs[-1].append(line)
+        elif paragraphs[-1]:
+            paragraphs.append([])
+    paragraphs = [p for p in paragraphs if p]
+
+    footer_start = len(paragraphs)
+    for idx in range(len(paragraphs) - 1, 0, -1):
+        para = paragraphs[idx]
+        if any(len(l) > _MAX_FOOTER_LINE_CHARS for l in para) or not any(map(_is_footer_line, para)):
+            break
+        footer_start = idx
+
+    kept = paragraphs[:footer_start] + [
+        [l for l in para if not _is_footer_line(l)] for para in paragraphs[footer_start:]
+    ]
+    return "\n\n".join("\n".join(p) for p in kept if p).split("\n")
+
+
+def strip_boilerplate(text: str) -> str:
+    """Drop signatures, legal/marketing footer lines and tracking URLs."""
+    lines = _cut_at_first(text.split("\n"), _SIGNATURE_RES)
+    text = "\n".join(_strip_footer_block(lines))
+    # Long tracking links carry no meaning for triage: keep just the host
+    text = _URL_RE.sub(lambda m: f"<link:{m.group(1)}>", text)
+    return _INVISIBLE_RE.sub("", text)
+
+
+def collapse_whitespace(text: str) -> str:
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = _SPACES_RE.sub(" ", text)
+    text = "\n".join(line.strip() for line in text.split("\n"))
+    return _BLANK_LINES_RE.sub("\n\n", text).strip()
+
+
+def truncate_to_tokens(text: str, token_budget: int) -> str:
+    """Cut `text` to roughly `token_budget` estimated tokens, on a word boundary."""
+    if token_budget <= 0 or estimate_tokens(text) <= token_budget:
+        return text
+    cut = text[: token_budget * 4]
+    space = cut.rfind(" ")
+    if space > len(cut) // 2:
+        cut = cut[:space]
+    return cut.rstrip() + TRUNCATION_MARKER
+
+
+def prepare_body(body: str, token_budget: Optional[int] = None) -> str:
+    """
+    Body text as sent to the classifier: quoted history, signatures and
+    boilerplate removed, whitespace collapsed, truncated to `token_budget`.
+    Falls back to the whitespace-collapsed original if stripping removes
+    everything (e.g. a body that is only a forwarded message).
+    """
+    if token_budget is None:
+        token_budget = get_default_body_token_budget()
+
+    text = collapse_whitespace(body or "")
+    cleaned = collapse_whitespace(strip_boilerplate(strip_quoted_history(text)))
+    return truncate_to_tokens(cleaned or text, token_budget)
+
+
+def prepare_email(email: Dict[str, str], token_budget: Optional[int] = None) -> Dict[str, str]:
+    """Copy of a raw email dict with its body prepared for classification."""
+    return {**email, "body": prepare_body(email.get("body", ""), token_budget)}
@@ -0,0 +1,279 @@
+# smart_email_agent/rate_limit.py
+
+import logging
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+    `rate` tokens are added per second, up to `capacity`.
+    acquire(n) blocks until n tokens are available; requests larger than the
+    bucket are let through once it is full and leave it in debt, so later
+    callers wait it off.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """Take `tokens`, sleeping as needed. Returns the seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                needed = min(tokens, self.capacity)
+                if self._tokens >= needed:
+                    self._tokens -= tokens
+                    return waited
+                delay = (needed - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+# ============================================================
+# Adaptive concurrency (AIMD)
+# ============================================================
+
+class AdaptiveConcurrency:
+    """
+    Concurrency gate whose limit adapts to throttling:
+    - every `increase_every` successes the limit grows by one (up to `max_limit`)
+    - every throttle (429 / rate-limit error) halves it (down to `min_limit`)
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1, increase_every: int = 10):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.increase_every = max(1, increase_every)
+        self.limit = self.max_limit
+        self._in_flight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+
+    def release(self) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self) -> None:
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.increase_every and self.limit < self.max_limit:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    def on_throttle(self) -> None:
+        with self._cond:
+            self.limit = max(self.min_limit, self.limit // 2)
+            self._successes = 0
+
+
+# ============================================================
+# Retry classification
+# ============================================================
+
+_THROTTLE_REASONS = (b"rateLimitExceeded", b"userRateLimitExceeded", b"RESOURCE_EXHAUSTED")
+
+
+def _status_of(exc: Exception) -> Optional[int]:
+    # openai.APIStatusError
+    status = getattr(exc, "status_code", None)
+    if isinstance(status, int):
+        return status
+    # googleapiclient.errors.HttpError
+    resp = getattr(exc, "resp", None)
+    status = getattr(resp, "status", None)
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _headers_of(exc: Exception) -> dict:
+    response = getattr(exc, "response", None)  # openai: httpx.Response
+    headers = getattr(response, "headers", None)
+    if headers is None:
+        headers = getattr(exc, "resp", None)  # googleapiclient: httplib2.Response (a dict)
+    try:
+        return {str(k).lower(): v for k, v in dict(headers or {}).items()}
+    except (TypeError, ValueError):
+        return {}
+
+
+def is_throttle(exc: Exception) -> bool:
+    """True for 429s and Gmail's 403 rate-limit variants."""
+    status = _status_of(exc)
+    if status == 429:
+        return True
+    if status == 403:
+        content = getattr(exc, "content", b"") or b""
+        if isinstance(content, str):
+            content = content.encode("utf-8", "ignore")
+        return any(reason in content for reason in _THROTTLE_REASONS)
+    return False
+
+
+def is_retryable(exc: Exception) -> bool:
+    """Throttles, 5xx responses, timeouts and connection errors."""
+    if is_throttle(exc):
+        return True
+    status = _status_of(exc)
+    if status is not None:
+        return status in (408, 409) or status >= 500
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    name = type(exc).__name__
+    return "Timeout" in name or "Connection" in name
+
+
+def retry_after_seconds(exc: Exception) -> Optional[float]:
+    """Server-requested delay from Retry-After / retry-after-ms headers, if any."""
+    headers = _headers_of(exc)
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000.0
+        except (TypeError, ValueError):
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+
+        when = parsedate_to_datetime(value)
+        return max(0.0, when.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# ============================================================
+# Per-API limiter: token bucket + adaptive concurrency + retries
+# ============================================================
+
+class ApiLimiter:
+    """
+    Wraps calls to one external API:
+    - paces them with a token bucket (`rate` tokens per second)
+    - bounds calls in flight with AdaptiveConcurrency (halved on 429s)
+    - retries throttles / transient errors with exponential backoff and
+      full jitter, honoring Retry-After when the server sends it
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        capacity: Optional[float] = None,
+        max_concurrency: int = 8,
+        max_attempts: int = 6,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ):
+        self.name = name
+        self.bucket = TokenBucket(rate=rate, capacity=capacity)
+        self.concurrency = AdaptiveConcurrency(max_limit=max_concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.throttles = 0
+        self.retries = 0
+
+    def backoff_delay(self, attempt: int, exc: Optional[Exception] = None) -> float:
+        """Delay before retry number `attempt` (1-based)."""
+        server_delay = retry_after_seconds(exc) if exc is not None else None
+        if server_delay is not None:
+            return min(self.max_delay, server_delay)
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+    def record_throttle(self) -> None:
+        self.throttles += 1
+        self.concurrency.on_throttle()
+
+    def call(self, fn: Callable[..., T], *args, tokens: float = 1.0, **kwargs) -> T:
+        """Run fn(*args, **kwargs) under this limiter, retrying transient failures."""
+        attempt = 0
+        while True:
+            attempt += 1
+            self.bucket.acquire(tokens)
+            self.concurrency.acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as exc:
+                if is_throttle(exc):
+                    self.record_throttle()
+                if attempt >= self.max_attempts or not is_retryable(exc):
+                    raise
+                error = exc
+            else:
+                self.concurrency.on_success()
+                return result
+            finally:
+                self.concurrency.release()
+
+            self.retries += 1
+            delay = self.backoff_delay(attempt, error)
+            logger.info("%s call failed (%s); retry %d in %.1fs", self.name, error, attempt, delay)
+            time.sleep(delay)
+
+
+_limiters: Dict[str, ApiLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def _default_limiter(name: str) -> ApiLimiter:
+    if name == "openai":
+        return ApiLimiter(
+            name,
+            rate=float(os.getenv("OPENAI_REQUESTS_PER_SEC", "8")),
+            max_concurrency=int(os.getenv("OPENAI_MAX_CONCURRENCY", "8")),
+        )
+    if name.startswith("gmail"):
+        # Tokens are Gmail quota units (250 units/user/second ceiling)
+        return ApiLimiter(
+            name,
+            rate=float(os.getenv("GMAIL_QUOTA_UNITS_PER_SEC", "200")),
+            max_concurrency=int(os.getenv("GMAIL_MAX_CONCURRENCY", "4")),
+        )
+    return ApiLimiter(name, rate=10.0)
+
+
+def get_limiter(name: str) -> ApiLimiter:
+    """Process-wide limiter for one API ("openai", "gmail:<account>:<user>", ...)."""
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            limiter = _default_limiter(name)
+            _limiters[name] = limiter
+        return limiter
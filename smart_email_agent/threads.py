@@ -0,0 +1,111 @@
+# smart_email_agent/threads.py
+
+# Thread-aware triage: new messages of one Gmail conversation are classified
+# together in a single model call. The prompt carries only what is new since
+# the last stored message of the thread (quoted history stripped) plus that
+# message's summary, instead of one full call per reply that re-reads the
+# whole quoted conversation.
+
+import os
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from .preprocess import get_default_body_token_budget, prepare_body, prepare_email
+from .storage import ThreadContext
+
+# Smallest body share per message when a long thread splits the budget
+_MIN_MESSAGE_TOKENS = 60
+
+
+def thread_triage_enabled() -> bool:
+    """Thread-aware triage is on unless THREAD_TRIAGE=0."""
+    return os.getenv("THREAD_TRIAGE", "1") != "0"
+
+
+@dataclass
+class ThreadGroup:
+    """New messages of one conversation (oldest first) and what is already stored."""
+    thread_id: Optional[str]
+    emails: List[Dict[str, str]] = field(default_factory=list)
+    prior: Optional[ThreadContext] = None
+
+    @property
+    def latest(self) -> Dict[str, str]:
+        return self.emails[-1]
+
+    @property
+    def superseded(self) -> bool:
+        """
+        A newer message of the thread is already stored: these are late
+        arrivals (e.g. an older page of a backfill), not the thread's latest.
+        """
+        return (
+            self.prior is not None
+            and self.prior.internal_date is not None
+            and self.prior.internal_date > received_at(self.latest)
+        )
+
+
+def received_at(e: Dict[str, str]) -> int:
+    """Gmail internalDate of a raw email in ms since epoch (0 if unknown)."""
+    try:
+        return int(e.get("internal_date") or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def group_by_thread(emails: List[Dict[str, str]]) -> List[ThreadGroup]:
+    """
+    Group raw emails by thread_id, in order of each thread's first
+    appearance; messages within a group are sorted oldest first.
+    Emails without a thread_id each get their own group.
+    """
+    groups: List[ThreadGroup] = []
+    by_thread: Dict[str, ThreadGroup] = {}
+    for e in emails:
+        thread_id = e.get("thread_id")
+        if not thread_id:
+            groups.append(ThreadGroup(thread_id=None, emails=[e]))
+            continue
+        group = by_thread.get(thread_id)
+        if group is None:
+            group = by_thread[thread_id] = ThreadGroup(thread_id=thread_id)
+            groups.append(group)
+        group.emails.append(e)
+
+    for group in groups:
+        group.emails.sort(key=received_at)  # stable: ties keep fetch order
+    return groups
+
+
+def build_thread_email(group: ThreadGroup, token_budget: Optional[int] = None) -> Dict[str, str]:
+    """
+    Raw-email-shaped dict to classify for a whole group: the latest
+    message's subject/sender with a body made of the prior thread summary
+    followed by each new message's own text. The body token budget is
+    shared between the new messages.
+    The stored summary is only included when it is older than the new
+    messages (see ThreadGroup.superseded). A lone message with no earlier
+    stored history is prepared as usual.
+    """
+    prior = None if group.superseded else group.prior
+    if prior is None and len(group.emails) == 1:
+        return prepare_email(group.latest, token_budget)
+
+    if token_budget is None:
+        token_budget = get_default_body_token_budget()
+    n = len(group.emails)
+    per_message = max(_MIN_MESSAGE_TOKENS, token_budget // n) if token_budget > 0 else 0
+
+    parts: List[str] = []
+    if prior is not None:
+        parts.append(
+            f"[Earlier in this thread, last classified {prior.urgency or 'unknown'}/"
+            f"{prior.category or 'unknown'}] {prior.summary or '(no summary)'}"
+        )
+    for k, e in enumerate(group.emails, 1):
+        parts.append(
+            f"[New message {k} of {n}] From: {e.get('sender', '')}\n"
+            f"{prepare_body(e.get('body', ''), per_message)}"
+        )
+    return {**group.latest, "body": "\n\n".join(parts)}
@@ -1,83 +1,512 @@
 # smart_email_agent/triage.py
 
-from typing import List, Optional
+import logging
+import os
+import socket
+import threading
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
 
-from .ai_classifier import classify_with_ai
+from .ai_classifier import classify_batch_with_ai, classify_with_ai, pack_email_batches
+from .classification_cache import ClassificationCache, classification_cache_key
 from .models import ProcessedEmail
+from .prefilter import prefilter_email, prefilter_enabled
+from .threads import (
+    ThreadGroup,
+    build_thread_email,
+    group_by_thread,
+    received_at,
+    thread_triage_enabled,
+)
 from .email_source import get_default_email_source, EmailSource, GmailEmailSource
 from .storage import Storage
 
+logger = logging.getLogger(__name__)
+
+
+def get_default_max_workers() -> int:
+    """
+    Max number of classification requests in flight at once.
+    Configurable via TRIAGE_MAX_WORKERS (default 4).
+    """
+    return max(1, int(os.getenv("TRIAGE_MAX_WORKERS", "4")))
+
+
+def get_default_batch_token_budget() -> int:
+    """
+    Prompt-token budget for packing several emails into one AI request.
+    Configurable via AI_BATCH_TOKEN_BUDGET; 0 (default) sends one email per request.
+    """
+    return max(0, int(os.getenv("AI_BATCH_TOKEN_BUDGET", "0")))
+
+
+def _classify_one(e: Dict[str, str]) -> Tuple[Optional[dict], Optional[Exception]]:
+    """Classify a single raw email, capturing the error instead of raising."""
+    try:
+        return classify_with_ai(
+            subject=e["subject"],
+            body=e["body"],
+            sender=e["sender"],
+        ), None
+    except Exception as ex:
+        return None, ex
+
+
+def _classify_concurrently(
+    raw_emails: List[Dict[str, str]],
+    max_workers: int,
+    batch_token_budget: int = 0,
+) -> List[Tuple[Optional[dict], Optional[Exception]]]:
+    if not raw_emails:
+        return []
+
+    if batch_token_budget > 0:
+        # Several emails per request; each packed request is one pool task
+        work = pack_email_batches(raw_emails, token_budget=batch_token_budget)
+        classify = classify_batch_with_ai
+    else:
+        work = raw_emails
+        classify = _classify_one
+
+    if max_workers <= 1 or len(work) == 1:
+        outputs = [classify(w) for w in work]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(work))) as pool:
+            # map() yields in submission order, so persistence stays deterministic
+            outputs = list(pool.map(classify, work))
+
+    if batch_token_budget <= 0:
+        return outputs
+
+    by_id: Dict[str, Tuple[Optional[dict], Optional[Exception]]] = {}
+    for batch_result in outputs:
+        by_id.update(batch_result)
+    return [by_id[e["id"]] for e in raw_emails]
+
+
+def get_default_classification_cache(storage: Optional[Storage]) -> Optional[ClassificationCache]:
+    """
+    Classification cache used by process_emails.
+    Disabled with CLASSIFICATION_CACHE=0.
+    """
+    if os.getenv("CLASSIFICATION_CACHE", "1") == "0":
+        return None
+    return ClassificationCache(storage)
+
+
+def classify_emails(
+    raw_emails: List[Dict[str, str]],
+    max_workers: Optional[int] = None,
+    cache: Optional[ClassificationCache] = None,
+    batch_token_budget: Optional[int] = None,
+) -> List[Tuple[Optional[dict], Optional[Exception]]]:
+    """
+    Classify raw emails concurrently with at most `max_workers` requests in flight.
+    Returns one (ai_result, error) pair per input email, in input order.
+
+    Content-identical emails are sent to the model once; with a `cache`,
+    cached results skip the API call entirely and fresh ones are stored.
+    With a `batch_token_budget` > 0, several emails share one request.
+    """
+    if max_workers is None:
+        max_workers = get_default_max_workers()
+    if batch_token_budget is None:
+        batch_token_budget = get_default_batch_token_budget()
+
+    keys = [classification_cache_key(e["sender"], e["subject"], e["body"]) for e in raw_emails]
+    cached = cache.get_many(keys) if cache is not None else {}
+
+    pending: Dict[str, Dict[str, str]] = {}
+    for key, e in zip(keys, raw_emails):
+        if key not in cached and key not in pending:
+            pending[key] = e
+
+    fresh = dict(
+        zip(
+            pending,
+            _classify_concurrently(list(pending.values()), max_workers, batch_token_budget),
+        )
+    )
+    if cache is not None:
+        cache.put_many({key: result for key, (result, error) in fresh.items() if error is None})
+
+    return [(cached[key], None) if key in cached else fresh[key] for key in keys]
+
+
+def build_processed_email(e: Dict[str, str], ai_result: dict) -> ProcessedEmail:
+    """Turn a raw email dict plus its AI result into a ProcessedEmail."""
+    pe = ProcessedEmail(
+        id=e["id"],
+        sender=e["sender"],
+        subject=e["subject"],
+        body=e["body"],
+        urgency=ai_result.get("urgency", "normal"),
+        category=ai_result.get("category", "personal"),
+        tasks=ai_result.get("tasks", []) or [],
+        summary=ai_result.get("summary", ""),
+    )
+    pe.reply_draft = ai_result.get("reply_draft", "")
+    return pe
+
+
+def triage_batch(
+    new_raw_emails: List[Dict[str, str]],
+    max_workers: Optional[int] = None,
+    cache: Optional[ClassificationCache] = None,
+    storage: Optional[Storage] = None,
+) -> Tuple[List[ProcessedEmail], Dict[str, Exception]]:
+    """
+    Turn new raw emails into ProcessedEmails, in input order:
+    - obvious promo/automated mail is routed by the local pre-classifier
+    - the rest is grouped per thread (see threads.py): each conversation is
+      classified once, from its new messages plus the stored thread summary
+      (with `storage`)
+    - bodies are cleaned (see preprocess.py) before going to the model
+    The latest message of a thread gets the tasks and reply draft; earlier
+    new messages share its urgency/category/summary (classified_by="thread"),
+    as do late arrivals older than a message already stored for the thread.
+    Returns (processed, errors) where `errors` maps the id of every email
+    whose classification failed to its exception.
+    """
+    # Local pre-classifier: high-confidence promo/automated mail skips the model
+    routed: Dict[int, ProcessedEmail] = {}
+    if prefilter_enabled():
+        for i, e in enumerate(new_raw_emails):
+            pe = prefilter_email(e)
+            if pe is not None:
+                routed[i] = pe
+
+    to_classify = [new_raw_emails[i] for i in range(len(new_raw_emails)) if i not in routed]
+    if thread_triage_enabled():
+        groups = group_by_thread(to_classify)
+        if storage is not None:
+            priors = storage.fetch_thread_contexts([g.thread_id for g in groups if g.thread_id])
+            for g in groups:
+                g.prior = priors.get(g.thread_id) if g.thread_id else None
+    else:
+        groups = [ThreadGroup(thread_id=None, emails=[e]) for e in to_classify]
+
+    # Strip quoted history/boilerplate and cap the body's token count for
+    # the prompt; the untouched body is what gets stored
+    prepared = [build_thread_email(g) for g in groups]
+
+    # AI-based classification, fanned out over a bounded worker pool
+    results: Dict[str, Tuple[Optional[dict], Optional[Exception], ThreadGroup]] = {}
+    for g, (ai_result, error) in zip(groups, classify_emails(prepared, max_workers=max_workers, cache=cache)):
+        for e in g.emails:
+            results[e["id"]] = (ai_result, error, g)
+    if cache is not None:
+        logger.info("Classification cache: %s", cache.stats())
+    if routed:
+        logger.info("Pre-classifier routed %d of %d email(s)", len(routed), len(new_raw_emails))
+    if len(groups) < len(to_classify):
+        logger.info("Thread-aware triage: %d email(s) in %d model call(s)", len(to_classify), len(groups))
+
+    processed: List[ProcessedEmail] = []
+    errors: Dict[str, Exception] = {}
+
+    for i, e in enumerate(new_raw_emails):
+        if i in routed:
+            pe = routed[i]
+        else:
+            ai_result, error, g = results[e["id"]]
+            if error is not None:
+                errors[e["id"]] = error
+                continue
+
+            pe = build_processed_email(e, ai_result)
+            if e is not g.latest or g.superseded:
+                # Tasks and the reply belong to the newest message of the thread
+                pe.tasks = []
+                pe.reply_draft = ""
+                pe.classified_by = "thread"
+
+        pe.thread_id = e.get("thread_id")
+        pe.message_id = e.get("message_id")
+        pe.in_reply_to = e.get("in_reply_to")
+        pe.internal_date = received_at(e) or None
+        processed.append(pe)
+
+    return processed, errors
+
+
+def _commit_batch(
+    source: EmailSource,
+    storage: Storage,
+    processed: List[ProcessedEmail],
+    mark_read_ids: List[str],
+) -> None:
+    """Save a batch in one transaction, then mark it read in Gmail in one bulk call."""
+    storage.save_processed_emails(processed)
+
+    if mark_read_ids and isinstance(source, GmailEmailSource):
+        result = source.mark_as_read(mark_read_ids)
+        for chunk, exc in result.failures:
+            logger.warning("Failed to mark %d email(s) as read: %s", len(chunk), exc)
+
+
+# ---------------------------
+# Durable work queue
+# ---------------------------
+
+def get_default_micro_batch_size() -> int:
+    """
+    Emails claimed, classified and committed together.
+    Configurable via TRIAGE_MICRO_BATCH (default 20).
+    """
+    return max(1, int(os.getenv("TRIAGE_MICRO_BATCH", "20")))
+
+
+def _max_attempts() -> int:
+    return max(1, int(os.getenv("TRIAGE_MAX_ATTEMPTS", "5")))
+
+
+def _retry_delay() -> timedelta:
+    return timedelta(seconds=float(os.getenv("TRIAGE_RETRY_DELAY_SECONDS", "60")))
+
+
+def _job_lease() -> timedelta:
+    return timedelta(seconds=float(os.getenv("TRIAGE_JOB_LEASE_SECONDS", "900")))
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def enqueue_new_emails(storage: Storage, raw_emails: List[Dict[str, str]], mark_read: bool = True) -> int:
+    """
+    Durably queue the emails not stored yet. `mark_read` is kept with each
+    job so whichever worker finishes it knows whether to mark it read.
+    Returns the number of newly queued jobs.
+    """
+    unseen_ids = set(storage.filter_unseen_email_ids([e["id"] for e in raw_emails]))
+    return storage.enqueue_jobs(
+        [{**e, "mark_read": mark_read} for e in raw_emails if e["id"] in unseen_ids]
+    )
+
+
+def _drain_queue(
+    source: EmailSource,
+    storage: Storage,
+    max_workers: Optional[int],
+    cache: Optional[ClassificationCache],
+    micro_batch_size: int,
+    worker_id: str,
+    errors: Dict[str, Exception],
+) -> Iterator[ProcessedEmail]:
+    """
+    Claim runnable jobs in micro-batches and process them until none are left.
+    Failed jobs are rescheduled with a delay (or marked failed after
+    TRIAGE_MAX_ATTEMPTS) and their exceptions collected in `errors`.
+    """
+    while True:
+        jobs = storage.claim_jobs(worker_id, limit=micro_batch_size, lease=_job_lease())
+        if not jobs:
+            return
+
+        payloads = [job.payload for job in jobs]
+        processed, batch_errors = triage_batch(payloads, max_workers=max_workers, cache=cache, storage=storage)
+
+        done_ids = {pe.id for pe in processed}
+        _commit_batch(
+            source,
+            storage,
+            processed,
+            mark_read_ids=[p["id"] for p in payloads if p["id"] in done_ids and p.get("mark_read", True)],
+        )
+        storage.complete_jobs([pe.id for pe in processed])
+        storage.fail_jobs(
+            {email_id: f"{type(exc).__name__}: {exc}" for email_id, exc in batch_errors.items()},
+            max_attempts=_max_attempts(),
+            retry_delay=_retry_delay(),
+        )
+        errors.update(batch_errors)
+
+        for pe in processed:
+            yield pe
+
 
 def process_emails(
     source: Optional[EmailSource] = None,
     storage: Optional[Storage] = None,
+    max_workers: Optional[int] = None,
+    cache: Optional[ClassificationCache] = None,
 ) -> List[ProcessedEmail]:
     """
     - Fetch raw emails from the source
     - Skip ones already stored in DB
-    - Process only NEW ones
-    - Use GPT-based classification ONLY (no rule-based fallback)
-    - Save results (and their tasks) to SQLite
+    - Queue the NEW ones durably (triage_jobs), then work through the queue,
+      including jobs left pending by earlier failed runs
+    - Classify up to `max_workers` concurrently
+      (cached classifications of identical content are reused)
+    - Route obvious promo/automated mail with the local pre-classifier
+      (PREFILTER_THRESHOLD); everything else goes to GPT
+    - Classify each conversation once: new replies in a thread are sent
+      together with the stored thread summary (THREAD_TRIAGE=0 disables)
+    - Send the model a cleaned, token-capped body (see preprocess.py)
+    - Save results (and their tasks) to PostgreSQL, in queue order
     - Return the list of newly processed emails
+
+    Failed classifications stay queued for a later retry; the first error
+    is re-raised once everything else has been processed.
     """
-    if source is None:
-        source = get_default_email_source()
     if storage is None:
         storage = Storage()
+    if source is None:
+        source = get_default_email_source(storage)
+    if cache is None:
+        cache = get_default_classification_cache(storage)
 
-    # 1) Fetch emails from source
-    raw_emails = source.get_emails()
-
-    # 2) Get already-seen IDs from DB
-    seen_ids = storage.get_seen_email_ids()
+    # 1) Fetch emails from source and queue the new ones
+    enqueue_new_emails(storage, source.get_emails())
 
-    # 3) Filter down to only new ones
-    new_raw_emails = [e for e in raw_emails if e["id"] not in seen_ids]
+    # 2) Everything fetched is durably queued: advance the incremental sync checkpoint
+    if isinstance(source, GmailEmailSource):
+        source.commit_checkpoint()
 
+    # 3) Claim, classify, save and mark read, one micro-batch at a time
     processed: List[ProcessedEmail] = []
-
-    for e in new_raw_emails:
-        subject = e["subject"]
-        body = e["body"]
-        sender = e["sender"]
-
-        # ---------- AI-based classification ONLY ----------
-        # Let any errors (quota, network, JSON, etc.) raise so you see them.
-        ai_result = classify_with_ai(
-            subject=subject,
-            body=body,
-            sender=sender,
+    errors: Dict[str, Exception] = {}
+    processed.extend(
+        _drain_queue(
+            source, storage, max_workers, cache, get_default_micro_batch_size(),
+            default_worker_id(), errors,
         )
+    )
 
-        summary = ai_result.get("summary", "")
-        urgency = ai_result.get("urgency", "normal")
-        category = ai_result.get("category", "personal")
-        tasks = ai_result.get("tasks", []) or []
-        reply_draft = ai_result.get("reply_draft", "")
-
-        # ---------- Build ProcessedEmail ----------
-        pe = ProcessedEmail(
-            id=e["id"],
-            sender=sender,
-            subject=subject,
-            body=body,
-            urgency=urgency,
-            category=category,
-            tasks=tasks,
-            summary=summary,
-        )
-        pe.reply_draft = reply_draft
+    # Let any errors (quota, network, JSON, etc.) raise so you see them,
+    # but only after the successful ones are persisted.
+    if errors:
+        raise next(iter(errors.values()))
 
-        processed.append(pe)
+    return processed
 
-        # Save to DB
-        storage.save_processed_email(pe)
 
-        # If we processed any Gmail emails, mark them as read in Gmail
-        if processed and isinstance(source, GmailEmailSource):
-            source.mark_as_read([e.id for e in processed])
+def _iter_source_pages(
+    source: EmailSource,
+    page_size: int,
+    max_messages: Optional[int],
+) -> Iterator[List[Dict[str, str]]]:
+    if isinstance(source, GmailEmailSource):
+        return source.iter_email_pages(page_size=page_size, max_messages=max_messages)
+    return iter([source.get_emails()[:max_messages]])
 
-    return processed
+
+def iter_process_emails(
+    source: Optional[EmailSource] = None,
+    storage: Optional[Storage] = None,
+    max_workers: Optional[int] = None,
+    cache: Optional[ClassificationCache] = None,
+    micro_batch_size: Optional[int] = None,
+    max_messages: Optional[int] = None,
+) -> Iterator[ProcessedEmail]:
+    """
+    Streaming version of process_emails for large backfills.
+
+    Emails are pulled from the source page by page, deduped against the DB
+    and queued, then claimed, classified, saved and marked read in
+    micro-batches of `micro_batch_size`. At most `max_messages` emails are
+    fetched (None = every unread email). Each ProcessedEmail is yielded once
+    its batch is committed, so memory stays bounded and callers can show
+    progress.
+
+    Failed classifications stay queued for a later retry; the first error
+    is raised at the end of the stream.
+    """
+    if storage is None:
+        storage = Storage()
+    if source is None:
+        source = get_default_email_source(storage)
+    if cache is None:
+        cache = get_default_classification_cache(storage)
+    if micro_batch_size is None:
+        micro_batch_size = get_default_micro_batch_size()
+
+    errors: Dict[str, Exception] = {}
+    yield from _process_pages(
+        _iter_source_pages(source, micro_batch_size, max_messages),
+        source,
+        storage,
+        max_workers=max_workers,
+        cache=cache,
+        micro_batch_size=micro_batch_size,
+        errors=errors,
+    )
+
+    if isinstance(source, GmailEmailSource):
+        source.commit_checkpoint()
+    if errors:
+        raise next(iter(errors.values()))
+
+
+def _process_pages(
+    pages: Iterator[List[Dict[str, str]]],
+    source: EmailSource,
+    storage: Storage,
+    max_workers: Optional[int],
+    cache: Optional[ClassificationCache],
+    micro_batch_size: int,
+    errors: Dict[str, Exception],
+    mark_read: bool = True,
+) -> Iterator[ProcessedEmail]:
+    """Queue each raw email page, then drain the queue in micro-batches."""
+    worker_id = default_worker_id()
+    for page in pages:
+        enqueue_new_emails(storage, page, mark_read=mark_read)
+        yield from _drain_queue(
+            source, storage, max_workers, cache, micro_batch_size, worker_id, errors,
+        )
+
+
+def iter_backfill(
+    query: str = "",
+    after: Optional[date] = None,
+    before: Optional[date] = None,
+    source: Optional[GmailEmailSource] = None,
+    storage: Optional[Storage] = None,
+    max_workers: Optional[int] = None,
+    cache: Optional[ClassificationCache] = None,
+    micro_batch_size: Optional[int] = None,
+    restart: bool = False,
+) -> Iterator[ProcessedEmail]:
+    """
+    Triage historical mail: every message matching a Gmail `query` within
+    [after, before), walked page by page with a resumable page-token
+    checkpoint (see GmailEmailSource.iter_backfill_pages).
+    Backfilled messages are stored but not marked as read.
+    """
+    if storage is None:
+        storage = Storage()
+    if source is None:
+        source = get_default_email_source(storage)
+    if source.storage is None:
+        source.storage = storage
+    if cache is None:
+        cache = get_default_classification_cache(storage)
+    if micro_batch_size is None:
+        micro_batch_size = get_default_micro_batch_size()
+
+    pages = source.iter_backfill_pages(
+        query=query,
+        after=after,
+        before=before,
+        page_size=micro_batch_size,
+        restart=restart,
+    )
+    errors: Dict[str, Exception] = {}
+    yield from _process_pages(
+        pages,
+        source,
+        storage,
+        max_workers=max_workers,
+        cache=cache,
+        micro_batch_size=micro_batch_size,
+        errors=errors,
+        mark_read=False,
+    )
+    if errors:
+        raise next(iter(errors.values()))
 
 
 def print_summary(emails: List[ProcessedEmail]) -> None:
@@ -0,0 +1,325 @@
+# smart_email_agent/worker.py
+
+import logging
+import os
+import random
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from multiprocessing import get_context
+from typing import Dict, List, Optional, Sequence, Set
+
+from .email_source import EmailSource, get_default_email_source
+from .storage import DEFAULT_ACCOUNT, Storage, close_connection_pools
+from .triage import default_worker_id, iter_process_emails
+
+logger = logging.getLogger(__name__)
+
+
+# ---------------------------
+# Settings
+# ---------------------------
+
+def get_default_accounts() -> List[str]:
+    """
+    Mailboxes to triage, from GMAIL_ACCOUNTS (comma-separated, e.g.
+    "work,personal"). Each account authorizes with its own
+    token_<account>.pickle. Defaults to the single default account.
+    """
+    raw = os.getenv("GMAIL_ACCOUNTS", "")
+    accounts = [a.strip() for a in raw.split(",") if a.strip()]
+    return accounts or [DEFAULT_ACCOUNT]
+
+
+def get_default_account_lease() -> timedelta:
+    """
+    How long a worker owns a mailbox without renewing its lease.
+    Configurable via WORKER_ACCOUNT_LEASE_SECONDS (default 600).
+    """
+    return timedelta(seconds=float(os.getenv("WORKER_ACCOUNT_LEASE_SECONDS", "600")))
+
+
+def get_default_poll_interval() -> float:
+    """
+    Seconds between daemon polls while mail keeps arriving.
+    Configurable via POLL_INTERVAL_SECONDS (default 60).
+    """
+    return max(1.0, float(os.getenv("POLL_INTERVAL_SECONDS", "60")))
+
+
+def get_default_max_poll_interval() -> float:
+    """
+    Upper bound for the idle backoff between daemon polls.
+    Configurable via POLL_MAX_INTERVAL_SECONDS (default 900).
+    """
+    return max(1.0, float(os.getenv("POLL_MAX_INTERVAL_SECONDS", "900")))
+
+
+def next_poll_delay(idle_polls: int, interval: float, max_interval: float, jitter: float = 0.1) -> float:
+    """
+    Delay before the next poll: `interval` doubled for every consecutive
+    idle poll (capped at `max_interval`), spread by +/- `jitter` so
+    several daemons don't poll Gmail in lockstep.
+    """
+    delay = min(max_interval, interval * (2 ** min(idle_polls, 16)))
+    return delay * random.uniform(1 - jitter, 1 + jitter)
+
+
+# ---------------------------
+# Graceful shutdown
+# ---------------------------
+
+class ShutdownFlag:
+    """
+    Set by SIGTERM/SIGINT. Long-running loops check it between micro-batches,
+    so in-flight classifications finish and their writes are committed
+    before the process exits.
+    """
+
+    def __init__(self) -> None:
+        self._event = threading.Event()
+
+    def install(self) -> "ShutdownFlag":
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self._handle)
+        return self
+
+    def _handle(self, signum, frame) -> None:
+        logger.info("Received signal %s; finishing in-flight work before exiting", signum)
+        self._event.set()
+
+    def set(self) -> None:
+        self._event.set()
+
+    def is_set(self) -> bool:
+        return self._event.is_set()
+
+    def wait(self, seconds: float) -> bool:
+        """Sleep up to `seconds`; returns True early if shutdown was requested."""
+        return self._event.wait(seconds)
+
+
+# ---------------------------
+# Worker
+# ---------------------------
+
+def triage_account(
+    account: str,
+    owner: str,
+    lease: timedelta,
+    coordinator: Storage,
+    storage: Optional[Storage] = None,
+    source: Optional[EmailSource] = None,
+    shutdown: Optional[ShutdownFlag] = None,
+) -> int:
+    """
+    Triage one mailbox while holding its lease, renewing the lease as
+    batches are committed. Stops early if the lease is lost or shutdown is
+    requested (after the current micro-batch is committed; unclaimed jobs
+    stay queued). `storage` / `source` are reused when given, otherwise
+    opened for this call.
+    A triage error (raised once the stream ends; failed jobs stay queued
+    for retry) is logged, not raised, so the emails that did go through
+    are still counted.
+    Returns the number of newly processed emails.
+    """
+    own_storage = storage is None
+    if storage is None:
+        storage = Storage(account=account)
+    try:
+        if source is None:
+            source = get_default_email_source(storage)
+        count = 0
+        last_renewal = time.monotonic()
+        try:
+            for _ in iter_process_emails(source=source, storage=storage, max_messages=source.max_results):
+                count += 1
+                if shutdown is not None and shutdown.is_set():
+                    break
+                if time.monotonic() - last_renewal >= lease.total_seconds() / 3:
+                    if not coordinator.renew_account(account, owner, lease):
+                        logger.warning("Lost the lease on account %s; stopping", account)
+                        break
+                    last_renewal = time.monotonic()
+        except Exception:
+            logger.exception("Triage error on account %s after %d new email(s)", account, count)
+        return count
+    finally:
+        if own_storage:
+            storage.close()
+
+
+def _run_pass(
+    accounts: Sequence[str],
+    worker_id: str,
+    lease: timedelta,
+    coordinator: Storage,
+    storages: Optional[Dict[str, Storage]] = None,
+    sources: Optional[Dict[str, EmailSource]] = None,
+    shutdown: Optional[ShutdownFlag] = None,
+    backlogged: Optional[Set[str]] = None,
+) -> int:
+    """
+    Lease and triage mailboxes one at a time until every account has been
+    run since the pass started (or shutdown is requested).
+    With `storages` / `sources`, per-account connections and Gmail clients
+    are kept there and reused across passes.
+    Accounts whose poll filled the source's `max_results` (more mail is
+    likely waiting) are added to `backlogged`.
+    """
+    started_at = datetime.now(timezone.utc)
+    total = 0
+    while shutdown is None or not shutdown.is_set():
+        account = coordinator.acquire_account(accounts, worker_id, lease, ran_before=started_at)
+        if account is None:
+            break
+
+        storage = source = None
+        if storages is not None and sources is not None:
+            if account not in storages:
+                storages[account] = Storage(account=account)
+                sources[account] = get_default_email_source(storages[account])
+            storage, source = storages[account], sources[account]
+
+        finished = False
+        try:
+            count = triage_account(
+                account, worker_id, lease, coordinator,
+                storage=storage, source=source, shutdown=shutdown,
+            )
+            logger.info("Worker %s triaged %d new email(s) for %s", worker_id, count, account)
+            total += count
+            if backlogged is not None and source is not None and count >= source.max_results:
+                backlogged.add(account)
+            finished = True
+        except Exception:
+            # Failed jobs stay queued; move on to the next mailbox
+            logger.exception("Worker %s failed on account %s", worker_id, account)
+            finished = True
+        finally:
+            coordinator.release_account(account, worker_id, finished=finished)
+    return total
+
+
+def run_worker(
+    accounts: Optional[Sequence[str]] = None,
+    worker_id: Optional[str] = None,
+    lease: Optional[timedelta] = None,
+) -> int:
+    """
+    Lease and triage mailboxes one at a time until every account has been
+    run since this worker started. Any number of workers (processes or
+    hosts) can share the same database: each account is owned by at most
+    one worker at a time, and the least recently run account goes first.
+    Returns the number of newly processed emails.
+    """
+    accounts = list(accounts or get_default_accounts())
+    worker_id = worker_id or default_worker_id()
+    lease = lease or get_default_account_lease()
+
+    coordinator = Storage()
+    try:
+        return _run_pass(accounts, worker_id, lease, coordinator)
+    finally:
+        coordinator.close()
+
+
+def run_daemon(
+    accounts: Optional[Sequence[str]] = None,
+    worker_id: Optional[str] = None,
+    lease: Optional[timedelta] = None,
+    interval: Optional[float] = None,
+    max_interval: Optional[float] = None,
+    shutdown: Optional[ShutdownFlag] = None,
+) -> int:
+    """
+    Long-running worker: repeat run_worker passes on a jittered interval,
+    doubling the delay while every mailbox comes back empty (up to
+    `max_interval`), and polling again right away while a mailbox still
+    has a backlog. A failed pass (e.g. a database outage) is logged and
+    backed off like an empty one. DB connections, Gmail clients and the
+    OpenAI client stay warm between polls.
+    SIGTERM/SIGINT stop it after in-flight micro-batches are committed.
+    Returns the number of newly processed emails.
+    """
+    accounts = list(accounts or get_default_accounts())
+    worker_id = worker_id or default_worker_id()
+    lease = lease or get_default_account_lease()
+    interval = interval or get_default_poll_interval()
+    max_interval = max(interval, max_interval or get_default_max_poll_interval())
+    if shutdown is None:
+        shutdown = ShutdownFlag().install()
+
+    coordinator = Storage()
+    storages: Dict[str, Storage] = {}
+    sources: Dict[str, EmailSource] = {}
+    total = 0
+    idle_polls = 0
+    try:
+        while not shutdown.is_set():
+            backlogged: Set[str] = set()
+            try:
+                count = _run_pass(
+                    accounts, worker_id, lease, coordinator,
+                    storages=storages, sources=sources, shutdown=shutdown,
+                    backlogged=backlogged,
+                )
+            except Exception:
+                logger.exception("Worker %s: poll failed", worker_id)
+                count = 0
+            total += count
+            idle_polls = 0 if count else idle_polls + 1
+            delay = 0.0 if backlogged else next_poll_delay(idle_polls, interval, max_interval)
+            logger.info("Worker %s: %d new email(s); next poll in %.0fs", worker_id, count, delay)
+            shutdown.wait(delay)
+    finally:
+        for storage in storages.values():
+            storage.close()
+        coordinator.close()
+        close_connection_pools()
+        logger.info("Worker %s stopped after %d new email(s)", worker_id, total)
+    return total
+
+
+def run_workers(processes: int, accounts: Optional[Sequence[str]] = None) -> int:
+    """
+    Run `processes` workers side by side on this host. More hosts can run
+    their own workers against the same database.
+    Returns the number of newly processed emails across all workers.
+    """
+    accounts = list(accounts or get_default_accounts())
+    if processes <= 1:
+        return run_worker(accounts)
+
+    # spawn: no psycopg2 connections or client threads inherited across fork
+    with ProcessPoolExecutor(max_workers=processes, mp_context=get_context("spawn")) as pool:
+        futures = [pool.submit(run_worker, accounts) for _ in range(processes)]
+        return sum(f.result() for f in futures)
+
+
+def run_daemons(processes: int, accounts: Optional[Sequence[str]] = None) -> None:
+    """
+    Run `processes` daemon workers on this host until SIGTERM/SIGINT,
+    which is forwarded to every child so each drains before exiting.
+    """
+    accounts = list(accounts or get_default_accounts())
+    if processes <= 1:
+        run_daemon(accounts)
+        return
+
+    ctx = get_context("spawn")
+    children = [ctx.Process(target=run_daemon, args=(accounts,)) for _ in range(processes)]
+    for child in children:
+        child.start()
+
+    def _forward(signum, frame):
+        for child in children:
+            if child.is_alive():
+                os.kill(child.pid, signal.SIGTERM)
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, _forward)
+    for child in children:
+        child.join()
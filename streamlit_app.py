@@ -1,16 +1,15 @@
 # streamlit_app.py
 
+from datetime import datetime, time, timedelta
+from typing import List, Optional
+
 import streamlit as st
 
-from smart_email_agent.triage import process_emails
+from smart_email_agent.triage import iter_process_emails
 from smart_email_agent.storage import Storage
 from smart_email_agent.email_source import GmailEmailSource
 from smart_email_agent.models import ProcessedEmail
-
-# ---------------------------
-# Storage (per run)
-# ---------------------------
-storage = Storage()
+from smart_email_agent.worker import get_default_accounts
 
 # ---------------------------
 # Global styles (technophilic vibes)
@@ -21,6 +20,13 @@ st.set_page_config(
     layout="wide",
 )
 
+# ---------------------------
+# Storage (per run, scoped to the selected mailbox; connections are pooled per process)
+# ---------------------------
+accounts = get_default_accounts()
+account = st.sidebar.selectbox("📮 Mailbox", accounts) if len(accounts) > 1 else accounts[0]
+storage = Storage(account=account)
+
 # Custom CSS for neon/tech look
 st.markdown(
     """
@@ -137,8 +143,24 @@ def category_badge(category: str) -> str:
     """
 
 
-def render_email_card(email: ProcessedEmail):
-    with st.expander(f"📧 {email.subject}", expanded=False):
+def render_email_card(
+    email: ProcessedEmail,
+    lazy_body: bool = False,
+    snippet: str = "",
+    duplicates: Optional[List[ProcessedEmail]] = None,
+):
+    """
+    Render one email card.
+    With lazy_body=True the body is not expected on `email` and is only
+    loaded from storage when the user asks for it (archive cards also offer
+    "similar emails").
+    `snippet` is a highlighted search match shown under the sender.
+    `duplicates` are near-duplicates collapsed into this card.
+    """
+    title = f"📧 {email.subject}"
+    if duplicates:
+        title += f"  (+{len(duplicates)} similar)"
+    with st.expander(title, expanded=False):
         st.markdown('<div class="email-card">', unsafe_allow_html=True)
 
         # Priority + Category labels with badges
@@ -153,6 +175,13 @@ def render_email_card(email: ProcessedEmail):
         )
 
         st.write(f"**From:** `{email.sender}`")
+        if email.classified_by == "prefilter":
+            score = f" ({email.prefilter_score:.0%} confidence)" if email.prefilter_score is not None else ""
+            st.caption(f"⚡ Routed by the local pre-classifier{score}, no AI call made.")
+        elif email.classified_by == "thread":
+            st.caption("🧵 Classified together with the newer messages of its thread.")
+        if snippet:
+            st.markdown(f"**Match:** …{snippet}…")
 
         st.write("---")
         st.write("**Summary:**")
@@ -161,8 +190,18 @@ def render_email_card(email: ProcessedEmail):
         else:
             st.write("_No summary available._")
 
-        with st.expander("🔍 Raw email body"):
-            st.text(email.body or "(no body)")
+        if lazy_body:
+            if st.checkbox("🔍 Show raw email body", key=f"archive-body-{email.id}"):
+                st.text(storage.fetch_email_body(email.id) or "(no body)")
+            if st.checkbox("🧭 Show similar emails", key=f"archive-similar-{email.id}"):
+                similar = storage.similar_emails(email.id, k=5)
+                if not similar:
+                    st.caption("No similar emails stored yet.")
+                for other, score in similar:
+                    st.write(f"- {score:.0%} · **{other.subject}** · `{other.sender}` ({other.category})")
+        else:
+            with st.expander("🔍 Raw email body"):
+                st.text(email.body or "(no body)")
 
         st.write("---")
         st.write("**Tasks detected:**")
@@ -172,6 +211,12 @@ def render_email_card(email: ProcessedEmail):
         else:
             st.write("_No tasks detected._")
 
+        if duplicates:
+            st.write("---")
+            st.write(f"**Near-duplicates collapsed into this card ({len(duplicates)}):**")
+            for other in duplicates:
+                st.write(f"- {other.subject} · `{other.sender}`")
+
         st.write("---")
         st.write("**AI Suggested Reply Draft:**")
         if email.reply_draft:
@@ -211,6 +256,15 @@ max_results = st.sidebar.slider(
     ),
 )
 
+incremental_sync = st.sidebar.checkbox(
+    "⚡ Incremental sync",
+    value=False,
+    help=(
+        "Only fetch mail that arrived since the last run (Gmail historyId checkpoint). "
+        "Falls back to a full unread scan when no checkpoint exists."
+    ),
+)
+
 process_button = st.sidebar.button("🚀 Run InboxIntel Now", use_container_width=True)
 
 st.sidebar.markdown("---")
@@ -234,29 +288,41 @@ st.sidebar.caption("Connected to Gmail • All email content stays local to you.
 # Main logic
 # ---------------------------
 
-source = GmailEmailSource(max_results=max_results)
+source = GmailEmailSource(
+    max_results=max_results,
+    storage=storage,
+    incremental=incremental_sync,
+    account=account,
+)
 
 new_emails: list[ProcessedEmail] = []
 
 if process_button:
     with st.spinner("Fetching and processing unread emails... 🧠⚡"):
+        progress = st.empty()
         try:
-            new_emails = process_emails(source=source, storage=storage)
+            # Results stream in per committed micro-batch
+            for pe in iter_process_emails(
+                source=source,
+                storage=storage,
+                max_messages=max_results,
+            ):
+                new_emails.append(pe)
+                progress.caption(f"Processed {len(new_emails)} email(s) so far...")
         except Exception as ex:
             st.error(f"Error while processing emails: {ex}")
+        progress.empty()
 
 
-# Fetch all stored emails for history view
-all_emails = storage.fetch_all_emails()
-
 # ---------------------------
-# Top metrics / status
+# Top metrics / status (aggregated in SQL)
 # ---------------------------
 
-total = len(all_emails)
-urgent_count = len([e for e in all_emails if (e.urgency or "").lower() == "urgent"])
-normal_count = len([e for e in all_emails if (e.urgency or "").lower() == "normal"])
-low_count = len([e for e in all_emails if (e.urgency or "").lower() == "low"])
+stats = storage.fetch_stats()
+total = stats.total
+urgent_count = stats.by_urgency.get("urgent", 0)
+normal_count = stats.by_urgency.get("normal", 0)
+low_count = stats.by_urgency.get("low", 0)
 
 col_a, col_b, col_c, col_d = st.columns(4)
 with col_a:
@@ -276,6 +342,18 @@ with col_d:
     st.metric("Low", low_count)
     st.markdown("</div>", unsafe_allow_html=True)
 
+if stats.per_day:
+    with st.expander("📈 Daily volume & categories"):
+        recent = stats.per_day[-30:]
+        st.bar_chart(
+            {"day": [d for d, _ in recent], "emails": [c for _, c in recent]},
+            x="day",
+            y="emails",
+        )
+        st.caption(
+            " • ".join(f"{c}: {n}" for c, n in sorted(stats.by_category.items()))
+        )
+
 st.write("")
 
 # ---------------------------
@@ -301,12 +379,18 @@ with tab_new:
 with tab_history:
     st.subheader("📚 All stored triaged emails")
 
-    if not all_emails:
+    if not total:
         st.info("No emails in the database yet. Process some emails first.")
     else:
-        st.caption(f"Total stored emails: {len(all_emails)}")
+        st.caption(f"Total stored emails: {total}")
+
+        search_query = st.text_input(
+            "🔎 Search subject, sender, summary and body",
+            value="",
+            help='Web-search syntax: "exact phrase", or, -exclude. Shows the best matches first.',
+        )
 
-        # Filter by urgency/category
+        # Filters are pushed down to PostgreSQL; empty filters match everything
         col1, col2 = st.columns(2)
         with col1:
             urgency_filter = st.multiselect(
@@ -321,22 +405,91 @@ with tab_history:
                 default=["work", "school", "personal", "promo", "automated"],
             )
 
-        # Flexible filtering: if filters empty, show everything
-        if not urgency_filter and not category_filter:
-            filtered = all_emails
+        col3, col4, col5, col6 = st.columns([2, 1, 1, 1])
+        with col3:
+            sender_filter = st.text_input("Sender contains", value="")
+        with col4:
+            since_date = st.date_input("Processed from", value=None)
+        with col5:
+            until_date = st.date_input("Processed until", value=None)
+        with col6:
+            page_size = st.selectbox("Per page", options=[10, 25, 50, 100], index=1)
+
+        since = datetime.combine(since_date, time.min) if since_date else None
+        until = datetime.combine(until_date, time.min) + timedelta(days=1) if until_date else None
+
+        if search_query.strip():
+            # Ranked full-text search (GIN index): top matches, no pagination
+            hits = storage.search_emails(
+                search_query.strip(),
+                urgencies=urgency_filter,
+                categories=category_filter,
+                sender=sender_filter.strip() or None,
+                since=since,
+                until=until,
+                limit=page_size,
+            )
+            if not hits:
+                st.warning("No emails match your search.")
+            else:
+                st.caption(f"Top {len(hits)} match(es)")
+                for hit in hits:
+                    render_email_card(hit.email, lazy_body=True, snippet=hit.snippet)
         else:
-            def matches(email: ProcessedEmail) -> bool:
-                u_ok = (not urgency_filter) or (email.urgency in urgency_filter)
-                c_ok = (not category_filter) or (email.category in category_filter)
-                return u_ok and c_ok
-
-            filtered = [e for e in all_emails if matches(e)]
+            # Keyset pagination: a stack of cursors, reset whenever the filters change
+            filter_key = (
+                tuple(urgency_filter),
+                tuple(category_filter),
+                sender_filter.strip(),
+                since,
+                until,
+                page_size,
+            )
+            if st.session_state.get("archive_filter_key") != filter_key:
+                st.session_state["archive_filter_key"] = filter_key
+                st.session_state["archive_cursors"] = [None]
+            cursors = st.session_state["archive_cursors"]
+
+            page = storage.query_emails(
+                urgencies=urgency_filter,
+                categories=category_filter,
+                sender=sender_filter.strip() or None,
+                since=since,
+                until=until,
+                after=cursors[-1],
+                limit=page_size,
+            )
 
-        if not filtered:
-            st.warning("No emails match the selected filters.")
-        else:
-            for e in filtered:
-                render_email_card(e)
+            if not page.emails:
+                st.warning("No emails match the selected filters.")
+            else:
+                # Collapse near-duplicate notifications on this page into one card
+                by_id = {e.id: e for e in page.emails}
+                for group in storage.near_duplicate_groups([e.id for e in page.emails]):
+                    render_email_card(
+                        by_id[group[0]],
+                        lazy_body=True,
+                        duplicates=[by_id[other] for other in group[1:]],
+                    )
+
+            def _next_page(cursor):
+                st.session_state["archive_cursors"].append(cursor)
+
+            def _prev_page():
+                st.session_state["archive_cursors"].pop()
+
+            nav_prev, nav_page, nav_next = st.columns([1, 2, 1])
+            with nav_prev:
+                st.button("◀ Previous", disabled=len(cursors) <= 1, on_click=_prev_page)
+            with nav_page:
+                st.caption(f"Page {len(cursors)}")
+            with nav_next:
+                st.button(
+                    "Next ▶",
+                    disabled=page.next_cursor is None,
+                    on_click=_next_page,
+                    args=(page.next_cursor,),
+                )
 
 # After all UI + loops at the bottom of the file
 storage.close()